@@ -6,6 +6,10 @@ dev_requires = [
     'Sphinx==1.2.2',
 ]
 
+numpy_requires = [
+    'numpy>=1.13',
+]
+
 install_requires = [
     'waldur-core>=0.151.1',
     'waldur_openstack>=0.38.2',
@@ -29,6 +33,7 @@ setup(
     zip_safe=False,
     extras_require={
         'dev': dev_requires,
+        'numpy': numpy_requires,
     },
     entry_points={
         'waldur_extensions': (
@@ -55,7 +55,11 @@ class DeploymentPlanItem(admin.TabularInline):
 class DeploymentPlanAdmin(admin.ModelAdmin):
     inlines = (DeploymentPlanItem,)
     search_fields = ('name',)
-    list_display = ('name', 'project')
+    list_display = ('name', 'project', 'cores', 'ram', 'storage')
+
+    def save_related(self, request, form, formsets, change):
+        super(DeploymentPlanAdmin, self).save_related(request, form, formsets, change)
+        form.instance.update_requirements()
 
 
 admin.site.register(models.Category, CategoryAdmin)
@@ -1,4 +1,5 @@
 from django.apps import AppConfig
+from django.db.models import signals
 
 
 class CostPlanningConfig(AppConfig):
@@ -6,4 +7,47 @@ class CostPlanningConfig(AppConfig):
     verbose_name = 'Cost planning'
 
     def ready(self):
+        from waldur_aws import models as aws_models
+        from waldur_core.cost_tracking import models as cost_tracking_models
+        from waldur_digitalocean import models as do_models
+        from waldur_openstack.openstack_tenant import models as ot_models
         from .plugins import digitalocean, openstack_tenant, aws, azure  # noqa: F401
+        from . import handlers, models
+
+        catalog_models = (
+            cost_tracking_models.DefaultPriceListItem,
+            cost_tracking_models.PriceListItem,
+            ot_models.Flavor,
+            aws_models.Size,
+            do_models.Size,
+        )
+        for model in catalog_models:
+            signals.post_save.connect(
+                handlers.invalidate_catalogs,
+                sender=model,
+                dispatch_uid='waldur_cost_planning.handlers.invalidate_catalogs_on_%s_save' % model._meta.label,
+            )
+
+            signals.post_delete.connect(
+                handlers.invalidate_catalogs,
+                sender=model,
+                dispatch_uid='waldur_cost_planning.handlers.invalidate_catalogs_on_%s_delete' % model._meta.label,
+            )
+
+        signals.post_save.connect(
+            handlers.update_plans_requirements_on_preset_change,
+            sender=models.Preset,
+            dispatch_uid='waldur_cost_planning.handlers.update_plans_requirements_on_preset_change',
+        )
+
+        signals.pre_delete.connect(
+            handlers.collect_plans_of_deleted_preset,
+            sender=models.Preset,
+            dispatch_uid='waldur_cost_planning.handlers.collect_plans_of_deleted_preset',
+        )
+
+        signals.post_delete.connect(
+            handlers.update_plans_requirements_on_preset_delete,
+            sender=models.Preset,
+            dispatch_uid='waldur_cost_planning.handlers.update_plans_requirements_on_preset_delete',
+        )
@@ -0,0 +1,166 @@
+""" Catalogs of service prices shared across evaluations.
+
+Price lists change rarely, so prices are kept in process-level LRU cache and
+in Django cache. Both layers are keyed by catalog version, which is stored in
+Django cache and bumped whenever price list item is changed, so all processes
+stop using stale prices at once.
+
+Catalogs of services built by optimizers, including their size indexes,
+are kept in process-level LRU cache by the same version, so they are not
+rebuilt on every request.
+
+The cheapest unit prices of service catalogs are cached the same way, so
+lower bounds of plan prices are computed without loading catalogs.
+
+Sizes of AWS, Azure and DigitalOcean are global for provider, so they are
+loaded once per process and shared by all services until version is changed.
+"""
+from __future__ import unicode_literals
+
+import collections
+import threading
+import time
+
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
+
+from .plugins import utils
+
+
+VERSION_CACHE_KEY = 'waldur_cost_planning:catalog_version'
+PRICES_CACHE_KEY = 'waldur_cost_planning:prices:%(version)s:%(service_type)s:%(service)s:%(resource_type)s'
+MIN_PRICE_CACHE_KEY = 'waldur_cost_planning:min_price:%(version)s:%(service_type)s:%(service)s'
+
+
+def get_version():
+    """ Return current version of catalogs """
+    version = cache.get(VERSION_CACHE_KEY)
+    if version is None:
+        # Use current time to make sure that version is not reused after cache eviction.
+        cache.add(VERSION_CACHE_KEY, int(time.time() * 1000), None)
+        version = cache.get(VERSION_CACHE_KEY)
+    return version
+
+
+def bump_version():
+    """ Invalidate all catalogs """
+    try:
+        cache.incr(VERSION_CACHE_KEY)
+    except ValueError:
+        cache.set(VERSION_CACHE_KEY, int(time.time() * 1000), None)
+
+
+class LRUCache(object):
+    """ Thread-safe LRU cache which entries expire after TTL seconds """
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            try:
+                expires_at, value = self._entries.pop(key)
+            except KeyError:
+                return None
+            if expires_at < time.time():
+                return None
+            self._entries[key] = (expires_at, value)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (time.time() + self.ttl, value)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+_prices_cache = LRUCache(
+    maxsize=settings.WALDUR_COST_PLANNING['price_catalog_size'],
+    ttl=settings.WALDUR_COST_PLANNING['price_catalog_ttl'],
+)
+
+
+_catalogs_cache = LRUCache(
+    maxsize=settings.WALDUR_COST_PLANNING['price_catalog_size'],
+    ttl=settings.WALDUR_COST_PLANNING['price_catalog_ttl'],
+)
+
+
+def get_service_catalog(service, load):
+    """ Return catalog of service built by given callable, for example size index.
+        Catalog is built once per process and reused until catalog version is changed.
+    """
+    cache_key = (get_version(), service._meta.label, service.pk)
+    catalog = _catalogs_cache.get(cache_key)
+    if catalog is None:
+        catalog = load(service)
+        _catalogs_cache.set(cache_key, catalog)
+    return catalog
+
+
+_sizes = {}
+_sizes_lock = threading.Lock()
+
+
+def get_provider_sizes(provider, load):
+    """ Return tuple of sizes of provider loaded by given callable.
+        Sizes are reloaded only when catalog version is changed.
+    """
+    version = get_version()
+    cached = _sizes.get(provider)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+
+    sizes = tuple(load())
+    with _sizes_lock:
+        _sizes[provider] = (version, sizes)
+    return sizes
+
+
+def get_service_prices(service, resource_model):
+    """ Return dictionary with items <(item type, key)>: <price> for all
+        price list items of resource model that belong to given service.
+    """
+    cache_key = PRICES_CACHE_KEY % {
+        'version': get_version(),
+        'service_type': ContentType.objects.get_for_model(service).id,
+        'service': service.pk,
+        'resource_type': ContentType.objects.get_for_model(resource_model).id,
+    }
+    return _get_cached(cache_key, lambda: {(item.item_type, item.key): item.value
+                                           for item in utils.get_service_price_list_items(service, resource_model)})
+
+
+def get_service_min_price(service, compute):
+    """ Return the cheapest unit price of service catalog computed by given callable.
+        Price is cached until catalogs are changed, None means that price is unknown.
+    """
+    cache_key = MIN_PRICE_CACHE_KEY % {
+        'version': get_version(),
+        'service_type': ContentType.objects.get_for_model(service).id,
+        'service': service.pk,
+    }
+    # Price is wrapped into tuple, because None is valid result
+    return _get_cached(cache_key, lambda: (compute(),))[0]
+
+
+def _get_cached(cache_key, compute):
+    value = _prices_cache.get(cache_key)
+    if value is not None:
+        return value
+
+    value = cache.get(cache_key)
+    if value is None:
+        value = compute()
+        cache.set(cache_key, value, settings.WALDUR_COST_PLANNING['price_catalog_ttl'])
+    _prices_cache.set(cache_key, value)
+    return value
@@ -0,0 +1,219 @@
+""" Caching of deployment plan evaluation results.
+
+Evaluation result depends only on plan items and names of their presets,
+required certifications, services that fit the plan and their names, and
+catalogs of prices, flavors and sizes. All of them are combined into
+fingerprint which is used both as cache key and ETag.
+
+The cheapest choices of each service for plan items are kept between
+evaluations, so when plan is edited only changed items are looked up.
+
+Several plans may be evaluated at once sharing services and catalogs.
+Large plans may be evaluated in background by evaluation jobs, their state
+and results are stored in cache until they expire.
+"""
+from __future__ import unicode_literals
+
+import hashlib
+import json
+import logging
+import time
+from uuid import uuid4
+
+from django.conf import settings
+from django.core.cache import cache
+from django.http import HttpRequest
+from django.utils.six.moves.urllib.parse import urljoin
+
+from . import catalogs, models, optimizers, serializers
+
+
+logger = logging.getLogger(__name__)
+
+EVALUATION_CACHE_KEY = 'waldur_cost_planning:evaluation:%s'
+JOB_CACHE_KEY = 'waldur_cost_planning:evaluation_job:%s'
+
+
+class Evaluation(object):
+    """ Fingerprinted evaluation of deployment plan for given base URL """
+
+    def __init__(self, deployment_plan, base_url, profiler=None, services=None, catalogs=None,
+                 limit=None, max_price=None, strategy='single', capacity=False):
+        self.deployment_plan = deployment_plan.get_snapshot()
+        self.base_url = base_url
+        self.profiler = profiler
+        self.catalogs = catalogs
+        self.limit = limit
+        self.max_price = max_price
+        self.strategy = strategy
+        if services is None:
+            services = optimizers.get_filtered_services(self.deployment_plan)
+        self.services = list(services)
+        # Remaining quotas are part of fingerprint, so they are loaded in advance
+        self.quotas = optimizers.get_remaining_quotas(self.services) if capacity else None
+        self.partials = None
+
+    def get_fingerprint_data(self):
+        plan = self.deployment_plan
+        return {
+            'plan': plan.uuid.hex,
+            'base_url': self.base_url,
+            # Names are rendered in result, so they are part of fingerprint too
+            'items': sorted([item.preset.uuid.hex, item.quantity, item.preset.cores, item.preset.ram,
+                             item.preset.storage, item.preset.name, item.preset.variant,
+                             item.preset.category.name] for item in plan.items),
+            'certifications': sorted(certification.pk for certification in plan.get_required_certifications()),
+            'services': sorted([service.settings.type, service.uuid.hex, service.settings.uuid.hex,
+                                service.settings.name] for service in self.services),
+            'catalog_version': catalogs.get_version(),
+            'limit': self.limit,
+            'max_price': self.max_price,
+            'strategy': self.strategy,
+            'quotas': sorted(self.quotas.items()) if self.quotas is not None else None,
+        }
+
+    @property
+    def fingerprint(self):
+        if not hasattr(self, '_fingerprint'):
+            data = json.dumps(self.get_fingerprint_data(), sort_keys=True, default=str)
+            self._fingerprint = hashlib.sha1(data.encode('utf-8')).hexdigest()
+        return self._fingerprint
+
+    def get_cached(self):
+        """ Return tuple (<serialized result>, <last modified timestamp>) or None """
+        return cache.get(EVALUATION_CACHE_KEY % self.fingerprint)
+
+    def get_strategy(self, profiler=None):
+        kwargs = dict(services=self.services, profiler=profiler, catalogs=self.catalogs, quotas=self.quotas)
+        strategy_class = optimizers.STRATEGIES[self.strategy]
+        if issubclass(strategy_class, optimizers.SingleServiceStrategy):
+            # Choices of previous evaluation are reused, so only changed plan items are looked up
+            self.partials = optimizers.PartialResults(self.deployment_plan.uuid.hex)
+            kwargs['partials'] = self.partials
+        if strategy_class is optimizers.SingleServiceStrategy and (
+                self.limit is not None or self.max_price is not None):
+            return optimizers.CheapestServicesStrategy(
+                self.deployment_plan, limit=self.limit, max_price=self.max_price, **kwargs)
+        return strategy_class(self.deployment_plan, **kwargs)
+
+    def evaluate(self, render):
+        """ Run optimization, render result with given callable and cache it """
+        strategy = self.get_strategy(profiler=self.profiler)
+        if self.profiler is None:
+            optimized_services = strategy.get_optimized()
+        else:
+            with self.profiler.measure_total(self.deployment_plan):
+                optimized_services = strategy.get_optimized()
+        return self._save(render(optimized_services))
+
+    def iter_evaluate(self, render):
+        """
+        Run optimization and yield result of each service rendered with given
+        callable as soon as it is ready. Result is cached when all services are optimized.
+        """
+        strategy = self.get_strategy()
+        data = []
+        for optimized_service in strategy.iter_optimized():
+            record = render(optimized_service)
+            data.append(record)
+            yield record
+        self._save(data)
+
+    def _save(self, data):
+        if self.partials is not None:
+            self.partials.save()
+        result = (data, int(time.time()))
+        cache.set(EVALUATION_CACHE_KEY % self.fingerprint, result,
+                  settings.WALDUR_COST_PLANNING['evaluation_cache_ttl'])
+        return result
+
+
+def evaluate_plans(deployment_plans, base_url, render):
+    """
+    Evaluate several deployment plans and return list of tuples (<plan>, <serialized result>).
+
+    Plans of the same project with the same required certifications share
+    discovered services, and all plans share catalogs of services, so prices,
+    sizes and flavors are loaded and indexed only once for each service.
+    """
+    catalogs = optimizers.CatalogCache()
+    services = {}
+    results = []
+    for plan in deployment_plans:
+        snapshot = plan.get_snapshot()
+        key = (snapshot.project.pk, frozenset(certification.pk
+                                              for certification in snapshot.get_required_certifications()))
+        if key not in services:
+            services[key] = list(optimizers.get_filtered_services(snapshot))
+        evaluation = Evaluation(snapshot, base_url, services=services[key], catalogs=catalogs)
+        data, _ = evaluation.get_cached() or evaluation.evaluate(render)
+        results.append((plan, data))
+    return results
+
+
+class BaseURLRequest(HttpRequest):
+    """ Request that is used to render hyperlinks outside of request-response cycle """
+
+    def __init__(self, base_url):
+        super(BaseURLRequest, self).__init__()
+        self.base_url = base_url
+
+    def build_absolute_uri(self, location=None):
+        return urljoin(self.base_url, location or '/')
+
+
+def render(optimized_services, base_url):
+    request = BaseURLRequest(base_url)
+    return serializers.OptimizedServiceSummarySerializer(
+        optimized_services, many=True, context={'request': request}).data
+
+
+class EvaluationJob(object):
+    """ Background evaluation of deployment plan """
+
+    class States(object):
+        PENDING = 'pending'
+        DONE = 'done'
+        ERRED = 'erred'
+
+    def __init__(self, plan_uuid, base_url, uuid=None, state=States.PENDING, result=None, error_message=''):
+        self.uuid = uuid or uuid4().hex
+        self.plan_uuid = plan_uuid
+        self.base_url = base_url
+        self.state = state
+        self.result = result
+        self.error_message = error_message
+
+    @classmethod
+    def get(cls, job_uuid):
+        """ Return job by UUID or None if job does not exist or is expired """
+        data = cache.get(JOB_CACHE_KEY % job_uuid)
+        return cls(**data) if data is not None else None
+
+    def save(self):
+        cache.set(JOB_CACHE_KEY % self.uuid, self.__dict__.copy(), settings.WALDUR_COST_PLANNING['evaluation_job_ttl'])
+
+    def submit(self):
+        """ Save job and schedule its execution """
+        from . import tasks
+
+        self.save()
+        if settings.WALDUR_COST_PLANNING['evaluation_jobs_eager']:
+            tasks.evaluate_deployment_plan.apply(args=(self.uuid,))
+        else:
+            tasks.evaluate_deployment_plan.delay(self.uuid)
+
+    def run(self):
+        try:
+            plan = models.DeploymentPlan.objects.get(uuid=self.plan_uuid)
+            evaluation = Evaluation(plan, self.base_url)
+            cached = evaluation.get_cached() or evaluation.evaluate(
+                render=lambda optimized_services: render(optimized_services, self.base_url))
+        except Exception as e:
+            logger.exception('Unable to evaluate deployment plan %s.', self.plan_uuid)
+            self.state = self.States.ERRED
+            self.error_message = str(e)
+        else:
+            self.state = self.States.DONE
+            self.result = cached[0]
+        self.save()
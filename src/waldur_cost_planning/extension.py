@@ -5,6 +5,16 @@ class CostPlanningExtension(WaldurExtension):
     class Settings:
         WALDUR_COST_PLANNING = {
             'currency': 'USD',
+            'price_catalog_ttl': 60 * 60,
+            'price_catalog_size': 1000,
+            'evaluation_cache_ttl': 24 * 60 * 60,
+            'optimization_workers': 1,
+            'evaluation_job_ttl': 60 * 60,
+            'evaluation_jobs_eager': False,
+            'vectorized_index_min_size': 500,
+            'instrumentation': False,
+            'batch_evaluation_max_plans': 100,
+            'capacity_time_budget': 1.0,
         }
 
     @staticmethod
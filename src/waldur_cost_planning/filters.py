@@ -10,9 +10,15 @@ class DeploymentPlanFilter(django_filters.FilterSet):
     project_uuid = django_filters.UUIDFilter(name='project__uuid')
     customer = core_filters.URLFilter(view_name='customer-detail', name='project__customer__uuid')
     customer_uuid = django_filters.UUIDFilter(name='project__customer__uuid')
+    ram__gte = django_filters.NumberFilter(name='ram', lookup_expr='gte')
+    ram__lte = django_filters.NumberFilter(name='ram', lookup_expr='lte')
+    cores__gte = django_filters.NumberFilter(name='cores', lookup_expr='gte')
+    cores__lte = django_filters.NumberFilter(name='cores', lookup_expr='lte')
+    storage__gte = django_filters.NumberFilter(name='storage', lookup_expr='gte')
+    storage__lte = django_filters.NumberFilter(name='storage', lookup_expr='lte')
 
     o = django_filters.OrderingFilter(
-        fields=('name', 'created')
+        fields=('name', 'created', 'ram', 'cores', 'storage')
     )
 
     class Meta(object):
@@ -0,0 +1,27 @@
+from __future__ import unicode_literals
+
+from . import catalogs, models
+
+
+def invalidate_catalogs(sender, instance, **kwargs):
+    catalogs.bump_version()
+
+
+def update_plans_requirements_on_preset_change(sender, instance, created=False, **kwargs):
+    # Tracker follows only resources of preset, so renaming does not touch plans
+    if created or not instance.tracker.changed():
+        return
+    plan_ids = models.DeploymentPlanItem.objects.filter(preset=instance).values('plan_id')
+    models.DeploymentPlan.update_requirements_of_plans(plan_ids)
+
+
+def collect_plans_of_deleted_preset(sender, instance, **kwargs):
+    # Items are deleted by cascade, so plans are collected before preset is deleted
+    items = models.DeploymentPlanItem.objects.filter(preset=instance).order_by()
+    instance._deleted_from_plan_ids = list(items.values_list('plan_id', flat=True).distinct())
+
+
+def update_plans_requirements_on_preset_delete(sender, instance, **kwargs):
+    plan_ids = getattr(instance, '_deleted_from_plan_ids', None)
+    if plan_ids:
+        models.DeploymentPlan.update_requirements_of_plans(plan_ids)
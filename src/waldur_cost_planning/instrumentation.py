@@ -0,0 +1,108 @@
+""" Instrumentation of deployment plan evaluation.
+
+Profiler records wall time, number of database queries, catalog size and
+number of solved plan items for each optimized service. Strategy measures
+services only if profiler is given, so disabled instrumentation costs
+nothing but a single check per service.
+
+Queries are counted per thread, so queries of services that are optimized by
+worker threads are added to total number of queries of the evaluation.
+"""
+from __future__ import unicode_literals
+
+import contextlib
+import logging
+import threading
+import time
+
+from django.db import connection
+
+
+logger = logging.getLogger(__name__)
+
+
+class QueryCounter(object):
+    """ Counts queries executed by database connection of the current thread """
+
+    def __init__(self):
+        self.count = 0
+        self._initial = 0
+        self._force_debug_cursor = False
+
+    def __enter__(self):
+        # Queries are logged by connection only if debug cursor is used
+        self._force_debug_cursor = connection.force_debug_cursor
+        connection.force_debug_cursor = True
+        connection.ensure_connection()
+        self._initial = len(connection.queries_log)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        connection.force_debug_cursor = self._force_debug_cursor
+        self.count = len(connection.queries_log) - self._initial
+
+
+class Profiler(object):
+    """ Collects metrics of deployment plan evaluation """
+
+    def __init__(self):
+        self.records = []
+        self.total = None
+        self._lock = threading.Lock()
+        self._thread = None
+        self._worker_queries = 0
+
+    @contextlib.contextmanager
+    def measure_service(self, service):
+        """ Measure optimization of service. Optimizer stats may be added to yielded record. """
+        record = {
+            'service_uuid': service.uuid.hex,
+            'service_type': service.settings.type,
+            'service_name': service.settings.name,
+            'catalog_size': None,
+            'items_solved': None,
+        }
+        started = time.time()
+        with QueryCounter() as queries:
+            yield record
+        record['wall_time'] = time.time() - started
+        record['queries'] = queries.count
+        with self._lock:
+            self.records.append(record)
+            if threading.current_thread() is not self._thread:
+                self._worker_queries += queries.count
+        logger.info('Service %(service_type)s %(service_uuid)s is optimized in %(wall_time).3fs '
+                    'with %(queries)s queries, catalog size: %(catalog_size)s, items solved: %(items_solved)s.',
+                    record, extra={'cost_planning_optimization': record})
+
+    @contextlib.contextmanager
+    def measure_total(self, deployment_plan):
+        self._thread = threading.current_thread()
+        started = time.time()
+        with QueryCounter() as queries:
+            yield
+        self.total = {
+            'plan_uuid': deployment_plan.uuid.hex,
+            'wall_time': time.time() - started,
+            'queries': queries.count + self._worker_queries,
+            'services': len(self.records),
+        }
+        logger.info('Deployment plan %(plan_uuid)s is evaluated for %(services)s services in %(wall_time).3fs '
+                    'with %(queries)s queries.', self.total, extra={'cost_planning_evaluation': self.total})
+
+    def get_server_timing(self):
+        """ Return value of Server-Timing header """
+        metrics = []
+        if self.total:
+            metrics.append('total;dur=%.1f;desc="%s queries"' % (self.total['wall_time'] * 1000, self.total['queries']))
+        for position, record in enumerate(self.records):
+            metrics.append('service-%s;dur=%.1f;desc="%s %s, %s queries, catalog size %s, items %s"' % (
+                position,
+                record['wall_time'] * 1000,
+                record['service_type'],
+                record['service_uuid'],
+                record['queries'],
+                record['catalog_size'],
+                record['items_solved'],
+            ))
+        return ', '.join(metrics)
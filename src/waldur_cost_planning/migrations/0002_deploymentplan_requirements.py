@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+def update_requirements(apps, schema_editor):
+    DeploymentPlan = apps.get_model('waldur_cost_planning', 'DeploymentPlan')
+    DeploymentPlanItem = apps.get_model('waldur_cost_planning', 'DeploymentPlanItem')
+
+    totals = DeploymentPlanItem.objects.order_by().values('plan').annotate(**{
+        name: models.Sum(models.F('preset__%s' % name) * models.F('quantity'), output_field=models.BigIntegerField())
+        for name in ('ram', 'cores', 'storage')
+    })
+    for row in totals:
+        DeploymentPlan.objects.filter(pk=row['plan']).update(ram=row['ram'], cores=row['cores'], storage=row['storage'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('waldur_cost_planning', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='deploymentplan',
+            name='cores',
+            field=models.BigIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='deploymentplan',
+            name='ram',
+            field=models.BigIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='deploymentplan',
+            name='storage',
+            field=models.BigIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(update_requirements, reverse_code=migrations.RunPython.noop),
+    ]
@@ -1,11 +1,14 @@
 from __future__ import unicode_literals
 
+import collections
 import logging
 
 from django.contrib.contenttypes.models import ContentType
 from django.db import models
+from django.db.models import functions
 from django.utils.encoding import python_2_unicode_compatible
 from django.utils.lru_cache import lru_cache
+from model_utils import FieldTracker
 from model_utils.models import TimeStampedModel
 
 from waldur_core.core import models as core_models
@@ -40,6 +43,10 @@ class DeploymentPlan(core_models.UuidMixin, core_models.NameMixin, TimeStampedMo
 
     project = models.ForeignKey(structure_models.Project, related_name='+')
     certifications = models.ManyToManyField(structure_models.ServiceCertification, blank=True)
+    # Total resources required by plan items, updated whenever items are changed
+    ram = models.BigIntegerField(default=0, editable=False)
+    cores = models.BigIntegerField(default=0, editable=False)
+    storage = models.BigIntegerField(default=0, editable=False)
 
     def __str__(self):
         return self.name
@@ -50,20 +57,79 @@ class DeploymentPlan(core_models.UuidMixin, core_models.NameMixin, TimeStampedMo
 
     def get_requirements(self):
         """ Return how many ram, cores and storage are required for plan """
-        requirements = {
-            'ram': 0,
-            'cores': 0,
-            'storage': 0,
+        return {
+            'ram': self.ram,
+            'cores': self.cores,
+            'storage': self.storage,
         }
-        for item in self.items.all():
-            requirements['ram'] += item.preset.ram * item.quantity
-            requirements['cores'] += item.preset.cores * item.quantity
-            requirements['storage'] += item.preset.storage * item.quantity
-        return requirements
+
+    def update_requirements(self):
+        """ Recalculate total resources required by plan items with single query and store them """
+        totals = self.items.aggregate(**{
+            name: models.Sum(models.F('preset__%s' % name) * models.F('quantity'),
+                             output_field=models.BigIntegerField())
+            for name in ('ram', 'cores', 'storage')
+        })
+        for name, total in totals.items():
+            setattr(self, name, total or 0)
+        DeploymentPlan.objects.filter(pk=self.pk).update(**self.get_requirements())
+
+    @classmethod
+    def update_requirements_of_plans(cls, plan_ids):
+        """ Recalculate total resources required by items of given plans with single UPDATE query """
+        items = DeploymentPlanItem.objects.filter(plan=models.OuterRef('pk')).order_by().values('plan')
+        cls.objects.filter(pk__in=plan_ids).update(**{
+            name: functions.Coalesce(models.Subquery(
+                items.annotate(total=models.Sum(models.F('preset__%s' % name) * models.F('quantity'),
+                                                output_field=models.BigIntegerField())).values('total'),
+                output_field=models.BigIntegerField()), 0)
+            for name in ('ram', 'cores', 'storage')
+        })
 
     def get_required_certifications(self):
         return set(list(self.certifications.all()) + list(self.project.certifications.all()))
 
+    def get_snapshot(self):
+        return DeploymentPlanSnapshot(self)
+
+
+PlanItem = collections.namedtuple('PlanItem', ('preset', 'quantity'))
+
+
+class DeploymentPlanSnapshot(object):
+    """
+    Immutable in-memory copy of deployment plan items.
+
+    Items are loaded together with presets and categories by single query
+    unless they are already prefetched, so snapshot could be shared by all optimizers instead of reading items
+    for each service. Snapshot could be used instead of deployment plan
+    wherever plan items are only read.
+    """
+    def __init__(self, plan):
+        self.plan = plan
+        if 'items' in getattr(plan, '_prefetched_objects_cache', {}):
+            items = plan.items.all()
+        else:
+            items = plan.items.select_related('preset__category')
+        self.items = tuple(PlanItem(preset=item.preset, quantity=item.quantity) for item in items)
+        self._required_certifications = None
+
+    @property
+    def uuid(self):
+        return self.plan.uuid
+
+    @property
+    def project(self):
+        return self.plan.project
+
+    def get_snapshot(self):
+        return self
+
+    def get_required_certifications(self):
+        if self._required_certifications is None:
+            self._required_certifications = frozenset(self.plan.get_required_certifications())
+        return self._required_certifications
+
 
 @python_2_unicode_compatible
 class DeploymentPlanItem(models.Model):
@@ -131,6 +197,7 @@ class Preset(core_models.UuidMixin, core_models.NameMixin):
     ram = models.PositiveIntegerField(default=0)
     cores = models.PositiveIntegerField(default=0, help_text='Preset cores count.')
     storage = models.PositiveIntegerField(default=0)
+    tracker = FieldTracker(fields=('ram', 'cores', 'storage'))
 
     def __str__(self):
         return '%s %s %s' % (self.variant, self.name, self.category)
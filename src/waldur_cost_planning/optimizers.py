@@ -1,78 +1,360 @@
 """ This module calculates the cheapest price for deployment plans. """
+import bisect
 import collections
+import operator
+import time
+from multiprocessing.pool import ThreadPool
 
-from waldur_core.structure import models as structure_models
+from django.apps import apps
+from django.conf import settings
+from django.core.cache import cache
+from django.contrib.contenttypes.models import ContentType
+from django.db import connection
+from django.db.models import Count
 
-from . import register
+from waldur_core.quotas import models as quotas_models
+from waldur_core.structure import SupportedServices, models as structure_models
+
+from . import catalogs, models, register
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 
 def get_filtered_services(deployment_plan):
-    """ Get services that fits deployment plan requirements """
-    service_models = structure_models.Service.get_all_models()
-    deployment_plan_certifications = deployment_plan.get_required_certifications()
-    for model in service_models:
+    """ Get services that fits deployment plan requirements.
+
+        Only service types with registered optimizer are queried and
+        certifications are checked by database, so number of queries
+        depends only on number of registered optimizers.
+    """
+    certifications = deployment_plan.get_required_certifications()
+    if certifications:
+        # Settings that have all required certifications
+        certified_settings = (
+            structure_models.ServiceSettings.objects
+            .filter(certifications__in=certifications)
+            .annotate(required_certifications_count=Count('certifications', distinct=True))
+            .filter(required_certifications_count=len(certifications))
+            .values('pk')
+        )
+
+    service_models = SupportedServices.get_service_models()
+    for service_type in sorted(service_models):
+        if not register.Register.get_optimizer(service_type):
+            continue
         services = (
-            model.objects
+            service_models[service_type]['service'].objects
             .filter(projects=deployment_plan.project)
             .select_related('settings')
-            .prefetch_related('settings__certifications')
         )
+        if certifications:
+            services = services.filter(settings__in=certified_settings)
         for service in services:
-            if set(service.settings.certifications.all()).issuperset(deployment_plan_certifications):
-                yield service
+            yield service
+
+
+QUOTA_NAMES = ('vcpu', 'ram', 'storage', 'instances')
+
+
+def get_remaining_quotas(services):
+    """ Return dictionary <service settings pk>: {<quota name>: <remaining amount or None if unlimited>}.
+        Quotas of settings of all services are loaded by single query.
+    """
+    settings_ids = set(service.settings.pk for service in services)
+    quotas = {settings_id: {} for settings_id in settings_ids}
+    if not settings_ids:
+        return quotas
+
+    content_type = ContentType.objects.get_for_model(structure_models.ServiceSettings)
+    rows = quotas_models.Quota.objects.filter(
+        content_type=content_type, object_id__in=settings_ids, name__in=QUOTA_NAMES,
+    ).values_list('object_id', 'name', 'limit', 'usage')
+    for settings_id, name, limit, usage in rows:
+        # Negative limit means that quota is unlimited
+        quotas[settings_id][name] = None if limit < 0 else max(limit - usage, 0)
+    return quotas
+
+
+class Record(object):
+    """ Lightweight result record with fixed set of fields.
+
+        Fields are declared by __slots__ of record class and its bases,
+        omitted fields get values from "defaults". Records do not have
+        instance dictionary and are pickled as plain tuples of field values.
+    """
+    __slots__ = ()
+    defaults = {}
+
+    def __init__(self, **kwargs):
+        fields = self.get_fields()
+        unknown = set(kwargs) - set(fields)
+        if unknown:
+            raise TypeError('%s got unexpected fields: %s' % (self.__class__.__name__, ', '.join(sorted(unknown))))
+        for name in fields:
+            setattr(self, name, kwargs.get(name, self.defaults.get(name)))
+
+    @classmethod
+    def get_fields(cls):
+        if '_fields' not in cls.__dict__:
+            cls._fields = tuple(name for klass in reversed(cls.__mro__) for name in klass.__dict__.get('__slots__', ()))
+        return cls._fields
+
+    def __getstate__(self):
+        return tuple(getattr(self, name) for name in self.get_fields())
 
+    def __setstate__(self, state):
+        for name, value in zip(self.get_fields(), state):
+            setattr(self, name, value)
 
-# http://stackoverflow.com/questions/11351032/named-tuple-and-optional-keyword-arguments
-def namedtuple_with_defaults(typename, field_names, default_values=()):
-    T = collections.namedtuple(typename, field_names)
-    T.__new__.__defaults__ = (None,) * len(T._fields)
-    if isinstance(default_values, collections.Mapping):
-        prototype = T(**default_values)
-    else:
-        prototype = T(*default_values)
-    T.__new__.__defaults__ = tuple(prototype)
-    T._defaults = tuple(prototype)  # added for easier access
-    return T
+    def __eq__(self, other):
+        return type(self) is type(other) and self.__getstate__() == other.__getstate__()
 
+    def __ne__(self, other):
+        return not self == other
 
-# Abstract object that represents the best choice for a particular service.
-OptimizedService = namedtuple_with_defaults(
-    'OptimizedService', ('service', 'price', 'error_message'), {'error_message': ''})
+    __hash__ = None
+
+    def __repr__(self):
+        return '%s(%s)' % (self.__class__.__name__, ', '.join(
+            '%s=%r' % (name, getattr(self, name)) for name in self.get_fields()))
+
+
+class OptimizedService(Record):
+    """ Abstract object that represents the best choice for a particular service.
+
+        Only identifiers and names of service and its settings are stored,
+        so record does not keep service objects alive and serializers render
+        hyperlinks from UUIDs.
+    """
+    __slots__ = ('service_model', 'service_pk', 'service_uuid',
+                 'settings_uuid', 'settings_name', 'settings_type', 'price', 'error_message')
+    defaults = {'error_message': ''}
+
+    def __init__(self, service=None, **kwargs):
+        if service is not None:
+            kwargs.update(
+                service_model=service._meta.label,
+                service_pk=service.pk,
+                service_uuid=service.uuid.hex,
+                settings_uuid=service.settings.uuid.hex,
+                settings_name=service.settings.name,
+                settings_type=service.settings.type,
+            )
+        super(OptimizedService, self).__init__(**kwargs)
+
+    @property
+    def service(self):
+        """ Load service from database. It is not needed to render the result. """
+        return apps.get_model(self.service_model).objects.get(pk=self.service_pk)
 
 
 class Strategy(object):
     """ Abstract. Defines how get the cheapest services setups for deployment plan. """
 
-    def __init__(self, deployment_plan):
-        self.deployment_plan = deployment_plan
+    def __init__(self, deployment_plan, services=None, profiler=None, catalogs=None, quotas=None, partials=None):
+        # Plan items are loaded once and shared by all optimizers
+        self.deployment_plan = deployment_plan.get_snapshot()
+        self.services = services
+        self.profiler = profiler
+        self.catalogs = catalogs
+        # Quotas of service settings, optimization is capacity-aware if they are given
+        self.quotas = quotas
+        # Choices of previous evaluation of the same plan
+        self.partials = partials
+
+    def get_services(self):
+        """ Return services that fits deployment plan requirements """
+        if self.services is None:
+            self.services = list(get_filtered_services(self.deployment_plan))
+        return self.services
+
+    def get_optimizer(self, service):
+        """ Return optimizer for service or None if service type is not supported """
+        optimizer_class = register.Register.get_optimizer(service.settings.type)
+        if optimizer_class:
+            quotas = None if self.quotas is None else self.quotas.get(service.settings.pk, {})
+            choices = None if self.partials is None else self.partials.get(service)
+            return optimizer_class(catalogs=self.catalogs, quotas=quotas, choices=choices)
 
     def get_optimized(self):
         """ Return list of OptimizedService objects """
         raise NotImplementedError()
 
+    def iter_optimized(self):
+        """ Yield OptimizedService objects """
+        return iter(self.get_optimized())
+
 
 class SingleServiceStrategy(Strategy):
     """ Optimize deployment plan for each service separately and return list
         of all available variants.
+
+        If "optimization_workers" setting is greater than 1, services are
+        optimized concurrently in thread pool. Each thread uses its own
+        database connection, order of results is the same as order of services.
     """
 
     def _get_optimized_service(self, service):
-        optimizer_class = register.Register.get_optimizer(service.settings.type)
-        if optimizer_class:
-            optimizer = optimizer_class()
+        optimizer = self.get_optimizer(service)
+        if optimizer:
+            if self.profiler is None:
+                return self._optimize(optimizer, service)
+            with self.profiler.measure_service(service) as record:
+                optimized_service = self._optimize(optimizer, service)
+                record.update(optimizer.stats)
+            return optimized_service
+
+    def _optimize(self, optimizer, service):
+        try:
+            return optimizer.optimize(self.deployment_plan, service)
+        except OptimizationError as e:
+            return OptimizedService(service=service, price=None, error_message=str(e))
+
+    def _get_optimized_service_in_thread(self, service):
+        try:
+            return self._get_optimized_service(service)
+        finally:
+            connection.close()
+
+    def get_optimized(self):
+        return list(self.iter_optimized())
+
+    def iter_optimized(self):
+        """ Yield OptimizedService objects one by one as soon as each service is optimized """
+        services = self.get_services()
+        workers = min(settings.WALDUR_COST_PLANNING['optimization_workers'], len(services))
+        if workers > 1:
+            pool = ThreadPool(workers)
             try:
-                return optimizer.optimize(self.deployment_plan, service)
-            except OptimizationError as e:
-                return OptimizedService(service=service, price=None, error_message=str(e))
+                for optimized_service in pool.imap(self._get_optimized_service_in_thread, services):
+                    if optimized_service:
+                        yield optimized_service
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            for service in services:
+                optimized_service = self._get_optimized_service(service)
+                if optimized_service:
+                    yield optimized_service
+
+
+class CheapestServicesStrategy(SingleServiceStrategy):
+    """ Return at most "limit" the cheapest services which price does not exceed "max_price".
+
+        Services are visited in order of their lower bounds, which are computed from
+        cached minimal prices of service catalogs. Service is optimized only if its
+        lower bound could beat the current top, so expensive services are skipped
+        without full optimization. Services that can not be set up are omitted
+        and results are sorted by price.
+    """
+
+    def __init__(self, deployment_plan, limit=None, max_price=None, **kwargs):
+        super(CheapestServicesStrategy, self).__init__(deployment_plan, **kwargs)
+        self.limit = limit
+        self.max_price = max_price
+        if self.catalogs is None:
+            # Catalog that is loaded for lower bound is reused by optimization
+            self.catalogs = CatalogCache()
+        self.skipped = 0
+
+    def _get_lower_bound(self, service):
+        optimizer = self.get_optimizer(service)
+        if optimizer:
+            return optimizer.get_lower_bound(self.deployment_plan, service)
+
+    def _can_be_skipped(self, lower_bound, optimized):
+        if self.max_price is not None and lower_bound > self.max_price:
+            return True
+        return self.limit is not None and len(optimized) >= self.limit and lower_bound >= optimized[-1].price
 
     def get_optimized(self):
+        services = self.get_services()
+        bounds = [self._get_lower_bound(service) for service in services]
+        candidates = sorted(((bound or 0, position) for position, bound in enumerate(bounds)))
+
         optimized = []
-        for service in get_filtered_services(self.deployment_plan):
-            optimized_service = self._get_optimized_service(service)
-            if optimized_service:
-                optimized.append(optimized_service)
+        for position, (lower_bound, service_position) in enumerate(candidates):
+            if self._can_be_skipped(lower_bound, optimized):
+                # Remaining services have greater or equal lower bounds
+                self.skipped = len(candidates) - position
+                break
+            optimized_service = self._get_optimized_service(services[service_position])
+            if not optimized_service or optimized_service.error_message:
+                continue
+            if self.max_price is not None and optimized_service.price > self.max_price:
+                continue
+            optimized.append(optimized_service)
+            optimized.sort(key=operator.attrgetter('price'))
+            if self.limit is not None:
+                del optimized[self.limit:]
         return optimized
 
+    def iter_optimized(self):
+        # Order of results is known only when all candidates are processed
+        return Strategy.iter_optimized(self)
+
+
+class SplitStrategy(Strategy):
+    """ Spread deployment plan across all suitable services of the project.
+
+        Price of single preset is computed for each service once, then each
+        plan item is assigned to the service with the cheapest price of its
+        preset. Prices of plan items do not depend on each other, so such
+        assignment gives the minimal total price without enumerating
+        combinations of services. Result contains OptimizedService object
+        for each service that got at least one item.
+    """
+
+    def _get_unit_prices(self, optimizer, service):
+        presets = [item.preset for item in self.deployment_plan.items]
+        if self.profiler is None:
+            return optimizer.get_unit_prices(service, presets)
+        with self.profiler.measure_service(service) as record:
+            unit_prices = optimizer.get_unit_prices(service, presets)
+            record.update(optimizer.stats)
+        return unit_prices
+
+    def get_optimized(self):
+        services = [service for service in self.get_services()
+                    if register.Register.get_optimizer(service.settings.type)]
+        service_optimizers = [self.get_optimizer(service) for service in services]
+        unit_prices = [self._get_unit_prices(optimizer, service)
+                       for optimizer, service in zip(service_optimizers, services)]
+
+        assignments = collections.defaultdict(list)
+        for item in self.deployment_plan.items:
+            requirements = get_preset_requirements(item.preset)
+            candidates = [(prices[requirements][1], position)
+                          for position, prices in enumerate(unit_prices) if requirements in prices]
+            if not candidates:
+                raise OptimizationError(
+                    'It is impossible to deploy preset %s on any of suitable services.' % item.preset.name)
+            _, position = min(candidates)
+            assignments[position].append(item)
+
+        optimized = []
+        for position in sorted(assignments):
+            optimizer, prices = service_optimizers[position], unit_prices[position]
+            optimized_presets = [optimizer.get_optimized_preset(item, prices[get_preset_requirements(item.preset)][0])
+                                 for item in assignments[position]]
+            optimized.append(optimizer.optimized_service_class(
+                service=services[position],
+                price=sum(optimized_preset.price for optimized_preset in optimized_presets),
+                optimized_presets=optimized_presets,
+            ))
+        return optimized
+
+
+# Strategies that could be chosen for evaluation of deployment plan
+STRATEGIES = collections.OrderedDict((
+    ('single', SingleServiceStrategy),
+    ('split', SplitStrategy),
+))
+
 
 # Optimizer should raise this error if it is impossible to setup
 # deployment plan for service
@@ -80,11 +362,529 @@ class OptimizationError(Exception):
     pass
 
 
+class CatalogCache(object):
+    """ Catalogs of services shared by optimizers of several deployment plans.
+
+        Catalog is loaded once for each service, so its size index and
+        the cheapest choices memoized by index are reused by all plans.
+        Error of catalog loading is remembered as well.
+    """
+
+    def __init__(self):
+        self._catalogs = {}
+
+    def get(self, service, load):
+        key = (service._meta.label, service.pk)
+        if key not in self._catalogs:
+            try:
+                self._catalogs[key] = (load(service), None)
+            except OptimizationError as e:
+                self._catalogs[key] = (None, e)
+        catalog, error = self._catalogs[key]
+        if error is not None:
+            raise error
+        return catalog
+
+
+class PartialResults(object):
+    """ The cheapest choices of each service for each preset requirements of deployment plan.
+
+        Choices are stored in cache together with catalog version, so when plan
+        items are changed only choices for new requirements are looked up,
+        and all choices are dropped as soon as prices or catalogs are changed.
+        Only primary keys of sizes and prices are stored, sizes are resolved from catalog.
+    """
+    CACHE_KEY = 'waldur_cost_planning:partial_results:%s'
+
+    def __init__(self, plan_uuid):
+        self.plan_uuid = plan_uuid
+        self.version = catalogs.get_version()
+        data = cache.get(self.CACHE_KEY % plan_uuid)
+        self.choices = data[1] if data is not None and data[0] == self.version else {}
+
+    def get(self, service):
+        """ Return dictionary <preset requirements>: <stored choice> of service """
+        return self.choices.setdefault((service._meta.label, service.pk), {})
+
+    def save(self):
+        # If catalogs are changed during optimization, choices are dropped on next load
+        cache.set(self.CACHE_KEY % self.plan_uuid, (self.version, self.choices),
+                  settings.WALDUR_COST_PLANNING['evaluation_cache_ttl'])
+
+    @classmethod
+    def prune(cls, plan_uuid, requirements):
+        """ Drop choices for requirements that are not used by plan anymore """
+        data = cache.get(cls.CACHE_KEY % plan_uuid)
+        if data is None:
+            return
+        version, choices = data
+        choices = {service: {key: choice for key, choice in service_choices.items() if key in requirements}
+                   for service, service_choices in choices.items()}
+        cache.set(cls.CACHE_KEY % plan_uuid, (version, choices),
+                  settings.WALDUR_COST_PLANNING['evaluation_cache_ttl'])
+
+    @classmethod
+    def clear(cls, plan_uuid):
+        cache.delete(cls.CACHE_KEY % plan_uuid)
+
+
+def get_preset_requirements(preset):
+    """ Return tuple (<cores>, <ram>, <storage>) of resources that preset requires """
+    return preset.cores, preset.ram, preset.storage
+
+
 class Optimizer(object):
     """ Abstract. Descendant should define how to get the cheapest setup for a
         particular service.
+
+        Presets with the same requirements share the same cheapest choice,
+        so it is looked up only once for each unique requirements tuple
+        and then fanned out to all plan items.
     """
+    optimized_service_class = NotImplemented
+
+    def __init__(self, catalogs=None, quotas=None, choices=None):
+        # Size of service catalog and number of plan items that optimizer has processed
+        self.stats = {}
+        self.catalogs = catalogs
+        # Dictionary <quota name>: <remaining amount or None if unlimited>.
+        # If it is given, optimizer should not exceed remaining quotas.
+        self.quotas = quotas
+        # Dictionary <preset requirements>: <stored choice> that is reused and filled
+        # by optimizer, so only choices for new requirements are looked up.
+        self.choices = choices
 
     def optimize(self, deployment_plan, service):
         """ Return the cheapest setup as OptimizedService object """
+        items = deployment_plan.get_snapshot().items
+        self.stats['items_solved'] = len(items)
+        choices = self.get_choices(service, [item.preset for item in items])
+        optimized_presets = [self.get_optimized_preset(item, choices[get_preset_requirements(item.preset)])
+                             for item in items]
+        price = sum(optimized_preset.price for optimized_preset in optimized_presets)
+        return self.optimized_service_class(service=service, price=price, optimized_presets=optimized_presets)
+
+    def get_choices(self, service, presets):
+        """ Return dictionary with items <preset requirements>: <the cheapest choice> """
+        catalog = self._get_catalog(service)
+        known = self.choices if self.choices is not None else {}
+        choices = {}
+        missing = []
+        for preset in presets:
+            requirements = get_preset_requirements(preset)
+            if requirements in choices:
+                continue
+            choice = self.load_choice(catalog, known[requirements]) if requirements in known else None
+            if choice is None:
+                missing.append(preset)
+            else:
+                choices[requirements] = choice
+        self.stats['choices_reused'] = len(choices)
+        if not missing:
+            return choices
+
+        unique_presets = self._solve_presets(catalog, missing)
+        solved = {requirements: self.get_cheapest_choice(catalog, preset)
+                  for requirements, preset in unique_presets.items()}
+        if self.choices is not None:
+            self.choices.update((requirements, self.dump_choice(choice)) for requirements, choice in solved.items())
+        choices.update(solved)
+        return choices
+
+    def dump_choice(self, choice):
+        """ Return choice as tuple of primary key of size and prices, so it is cheap to store.
+            Choice is expected to be tuple (<size from index>, <price>, ...).
+        """
+        return (choice[0].pk,) + tuple(choice[1:])
+
+    def load_choice(self, catalog, data):
+        """ Return choice stored by dump_choice or None if its size is not in catalog anymore """
+        size = self.get_index(catalog).get_size(data[0])
+        if size is None:
+            return None
+        return (size,) + tuple(data[1:])
+
+    def get_unit_prices(self, service, presets):
+        """ Return dictionary with items <preset requirements>: (<the cheapest choice>, <price of single preset>).
+            Presets that could not be deployed on service are omitted.
+        """
+        try:
+            catalog = self._get_catalog(service)
+        except OptimizationError:
+            return {}
+        unit_prices = {}
+        for requirements, preset in self._solve_presets(catalog, presets).items():
+            try:
+                choice = self.get_cheapest_choice(catalog, preset)
+            except OptimizationError:
+                continue
+            price = self.get_optimized_preset(models.PlanItem(preset=preset, quantity=1), choice).price
+            unit_prices[requirements] = (choice, price)
+        return unit_prices
+
+    def _solve_presets(self, catalog, presets):
+        """ Return unique presets by requirements and look them up in index """
+        unique_presets = collections.OrderedDict()
+        for preset in presets:
+            unique_presets.setdefault(get_preset_requirements(preset), preset)
+
+        # Solve all presets at once, so vectorized index could handle them in one pass.
+        index = self.get_index(catalog)
+        self.stats['catalog_size'] = len(index)
+        index.get_cheapest_many([self.get_index_requirements(preset) for preset in unique_presets.values()])
+        return unique_presets
+
+    def get_lower_bound(self, deployment_plan, service):
+        """ Return price that the cheapest setup of deployment plan for service
+            can not be lower than, or None if it is unknown.
+        """
+        min_price = catalogs.get_service_min_price(service, lambda: self._get_min_price(service))
+        if min_price is None:
+            return None
+        return min_price * sum(item.quantity for item in deployment_plan.get_snapshot().items)
+
+    def _get_min_price(self, service):
+        try:
+            return self.get_min_price(self._get_catalog(service))
+        except OptimizationError:
+            return None
+
+    def _get_catalog(self, service):
+        if self.catalogs is None:
+            return catalogs.get_service_catalog(service, self.get_catalog)
+        return self.catalogs.get(service, lambda service: catalogs.get_service_catalog(service, self.get_catalog))
+
+    def get_catalog(self, service):
+        """ Return everything that is needed to find the cheapest choices for service """
+        raise NotImplementedError()
+
+    def get_min_price(self, catalog):
+        """ Return price of the cheapest choice in service catalog regardless of preset """
+        return self.get_index(catalog).min_price
+
+    def get_index(self, catalog):
+        """ Return size catalog index of service catalog """
+        return catalog
+
+    def get_index_requirements(self, preset):
+        """ Return preset requirements in order of size catalog index attributes """
+        return preset.cores, preset.ram, preset.storage
+
+    def get_cheapest_choice(self, catalog, preset):
+        """ Return the cheapest choice for preset or raise OptimizationError """
+        raise NotImplementedError()
+
+    def get_optimized_preset(self, item, choice):
+        """ Return object that describes how plan item is deployed using choice """
         raise NotImplementedError()
+
+
+class CapacityPacker(object):
+    """ Choose one candidate for each item, so that total resources of all items
+        fit into capacity and total price is minimal.
+
+        Each item is defined by quantity and list of candidates
+        (<unit price>, <unit resources>, <choice>). Capacity is tuple of
+        available resources, None means that resource is unlimited.
+
+        Problem is solved by depth-first branch and bound. Candidates that are
+        not cheaper and do not use less resources than another candidate are
+        dropped, branches that could not beat the best solution or could not
+        fit remaining capacity are cut. Greedy solution is used as initial
+        upper bound, if time budget is exceeded the best found solution is returned.
+    """
+    CLOCK_CHECK_INTERVAL = 1000
+
+    def __init__(self, items, capacity, time_budget):
+        self.dimensions = [position for position, amount in enumerate(capacity) if amount is not None]
+        self.capacity = tuple(capacity[position] for position in self.dimensions)
+        self.time_budget = time_budget
+        self.timed_out = False
+        self.nodes = 0
+        self.best = None
+
+        self.items = []
+        for quantity, candidates in items:
+            demands = [(price * quantity, tuple(resources[position] * quantity for position in self.dimensions), choice)
+                       for price, resources, choice in sorted(candidates, key=operator.itemgetter(0))]
+            self.items.append(self._prune(demands))
+
+        # The tightest items are solved first, so infeasible branches are cut early
+        self.order = sorted(range(len(self.items)), key=self._get_tightness, reverse=True)
+        self.min_costs = [0] * (len(self.order) + 1)
+        self.min_resources = [(0,) * len(self.dimensions)] * (len(self.order) + 1)
+        for position in reversed(range(len(self.order))):
+            candidates = self.items[self.order[position]]
+            self.min_costs[position] = self.min_costs[position + 1] + candidates[0][0]
+            self.min_resources[position] = tuple(
+                total + min(candidate[1][dimension] for candidate in candidates)
+                for dimension, total in enumerate(self.min_resources[position + 1]))
+
+    @staticmethod
+    def _prune(demands):
+        kept = []
+        for demand in demands:
+            if not any(all(used <= other for used, other in zip(cheaper[1], demand[1])) for cheaper in kept):
+                kept.append(demand)
+        return kept
+
+    def _get_tightness(self, index):
+        resources = self.items[index][0][1]
+        return sum(float(used) / amount if amount else float('inf') if used else 0
+                   for used, amount in zip(resources, self.capacity))
+
+    @staticmethod
+    def _fits(resources, capacity):
+        return all(used <= amount for used, amount in zip(resources, capacity))
+
+    def get_shortage(self):
+        """ Return list of tuples (<dimension>, <minimal required amount>, <available amount>)
+            for resources which capacity is not enough even for the least demanding candidates.
+        """
+        return [(dimension, required, available)
+                for dimension, required, available in zip(self.dimensions, self.min_resources[0], self.capacity)
+                if required > available]
+
+    def solve(self):
+        """ Return list of chosen candidates in order of items or None if items do not fit capacity """
+        if not self._fits(self.min_resources[0], self.capacity):
+            return None
+
+        self.best = self._solve_greedily()
+        self.deadline = time.time() + self.time_budget
+        self._search(0, 0, self.capacity, [])
+        if self.best is None:
+            return None
+
+        choices = [None] * len(self.items)
+        for index, choice in zip(self.order, self.best[1]):
+            choices[index] = choice
+        return choices
+
+    def _solve_greedily(self):
+        cost, remaining, chosen = 0, self.capacity, []
+        for position, index in enumerate(self.order):
+            for price, resources, choice in self.items[index]:
+                left = tuple(amount - used for amount, used in zip(remaining, resources))
+                if self._fits(self.min_resources[position + 1], left):
+                    cost, remaining = cost + price, left
+                    chosen.append(choice)
+                    break
+            else:
+                return None
+        return cost, chosen
+
+    def _search(self, position, cost, remaining, chosen):
+        if position == len(self.order):
+            if self.best is None or cost < self.best[0]:
+                self.best = (cost, list(chosen))
+            return
+
+        self.nodes += 1
+        if self.nodes % self.CLOCK_CHECK_INTERVAL == 0 and time.time() > self.deadline:
+            self.timed_out = True
+        if self.timed_out:
+            return
+
+        for price, resources, choice in self.items[self.order[position]]:
+            if self.best is not None and cost + price + self.min_costs[position + 1] >= self.best[0]:
+                # Candidates are sorted by price, so the rest are not better
+                break
+            left = tuple(amount - used for amount, used in zip(remaining, resources))
+            if not self._fits(self.min_resources[position + 1], left):
+                continue
+            chosen.append(choice)
+            self._search(position + 1, cost + price, left, chosen)
+            chosen.pop()
+            if self.timed_out:
+                return
+
+
+def _get_non_dominated(entries):
+    """ Return entries that are not dominated by any previous entry.
+
+        Entries are tuples (<price>, <resource 1>, ..., <resource N>, <size>)
+        sorted by price. Entry is dominated if some previous entry has at least
+        the same amount of each resource. Previous entries are grouped by all
+        resources except the last two ones and each group keeps its staircase:
+        pairs of the last two resources where the first one ascends and the second
+        one descends. So entry is checked with a binary search per suitable group.
+    """
+    groups = {}
+    keys = []
+    result = []
+    for entry in entries:
+        resources = entry[1:-1]
+        if len(resources) < 2:
+            resources = (0,) + resources
+        key, first, last = resources[:-2], resources[-2], resources[-1]
+
+        dominated = False
+        # Keys are sorted, so groups that precede entry key have less resources.
+        # Keys of single resource that follow it have more, longer keys are compared.
+        for other_key in keys[bisect.bisect_left(keys, key):]:
+            if len(key) > 1 and any(other < own for other, own in zip(other_key, key)):
+                continue
+            firsts, lasts = groups[other_key]
+            position = bisect.bisect_left(firsts, first)
+            if position < len(firsts) and lasts[position] >= last:
+                dominated = True
+                break
+        if dominated:
+            continue
+
+        result.append(entry)
+        if key not in groups:
+            bisect.insort(keys, key)
+            groups[key] = ([], [])
+        # Pairs of the group that are dominated by the new one are replaced with it
+        firsts, lasts = groups[key]
+        end = bisect.bisect_left(firsts, first)
+        if end < len(firsts) and firsts[end] == first:
+            end += 1
+        start = end
+        while start > 0 and lasts[start - 1] <= last:
+            start -= 1
+        firsts[start:end] = [first]
+        lasts[start:end] = [last]
+    return result
+
+
+class SizeCatalogIndex(object):
+    """ Index of service sizes that answers "the cheapest size with cores >= c,
+        ram >= r and disk >= d" queries.
+
+        Sizes are sorted by price once and dominated sizes, i.e. sizes that cost
+        more than another size without offering more of any resource, are dropped.
+        Query returns the first remaining size that has enough resources instead
+        of filtering the whole catalog and looking for minimum, so it scans only
+        non-dominated sizes. Answers are memoized.
+        If several sizes have the same price the first one from the catalog wins.
+    """
+
+    def __init__(self, sizes, get_price, attributes=('cores', 'ram', 'disk')):
+        self.attributes = attributes
+        self._cheapest = {}
+        self._sizes_by_pk = None
+        # Entries are flat tuples (<price>, <resource 1>, ..., <resource N>, <size>)
+        entries = sorted(((get_price(size),) + tuple(getattr(size, name) for name in attributes) + (size,)
+                          for size in sizes),
+                         key=operator.itemgetter(0))
+        self.entries = _get_non_dominated(entries)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get_size(self, pk):
+        """ Return size with given primary key or None if it is not in index """
+        if self._sizes_by_pk is None:
+            self._sizes_by_pk = {entry[-1].pk: entry[-1] for entry in self.entries}
+        return self._sizes_by_pk.get(pk)
+
+    @property
+    def min_price(self):
+        """ Price of the cheapest size or None if catalog is empty """
+        return self.entries[0][0] if self.entries else None
+
+    def get_cheapest(self, *requirements):
+        """ Return tuple (<size>, <price>) for the cheapest size that satisfies
+            requirements or None if there is no such size.
+            Requirements should be given in the same order as index attributes.
+        """
+        if requirements not in self._cheapest:
+            self._cheapest[requirements] = self._find_cheapest(requirements)
+        return self._cheapest[requirements]
+
+    def get_cheapest_many(self, requirements_list):
+        """ Return list of the cheapest sizes for each requirements tuple """
+        return [self.get_cheapest(*requirements) for requirements in requirements_list]
+
+    def _find_cheapest(self, requirements):
+        # Comparisons are written out for common number of attributes, it is several times faster
+        if len(requirements) == 3:
+            first, second, third = requirements
+            suitable = (entry for entry in self.entries
+                        if entry[1] >= first and entry[2] >= second and entry[3] >= third)
+        elif len(requirements) == 2:
+            first, second = requirements
+            suitable = (entry for entry in self.entries if entry[1] >= first and entry[2] >= second)
+        else:
+            suitable = (entry for entry in self.entries
+                        if all(resource >= requirement for resource, requirement in zip(entry[1:-1], requirements)))
+        entry = next(suitable, None)
+        return None if entry is None else (entry[-1], entry[0])
+
+
+class VectorizedSizeCatalogIndex(object):
+    """ NumPy implementation of SizeCatalogIndex.
+
+        Resources of sizes are packed into columns ordered by price, so all
+        requirements are matched against all sizes at once with broadcasting
+        and the cheapest suitable size is the first one in the matrix.
+        Dominated sizes are dropped the same way as in SizeCatalogIndex.
+        Large inputs are processed in chunks to limit memory usage.
+    """
+    CHUNK_SIZE = 256
+
+    def __init__(self, sizes, get_price, attributes=('cores', 'ram', 'disk')):
+        self.attributes = attributes
+        self._cheapest = {}
+        self._sizes_by_pk = None
+        entries = _get_non_dominated(sorted(
+            ((get_price(size),) + tuple(getattr(size, name) for name in attributes) + (size,) for size in sizes),
+            key=operator.itemgetter(0)))
+        resources = numpy.array([entry[1:-1] for entry in entries],
+                                dtype=numpy.int64).reshape(len(entries), len(attributes))
+        self.prices = [entry[0] for entry in entries]
+        self.sizes = [entry[-1] for entry in entries]
+        # Each resource is stored as separate contiguous column, comparing columns one by one
+        # is much faster than broadcasting of the whole matrix
+        self.columns = [numpy.ascontiguousarray(column) for column in resources.T]
+
+    def __len__(self):
+        return len(self.sizes)
+
+    def get_size(self, pk):
+        """ Return size with given primary key or None if it is not in index """
+        if self._sizes_by_pk is None:
+            self._sizes_by_pk = {size.pk: size for size in self.sizes}
+        return self._sizes_by_pk.get(pk)
+
+    @property
+    def min_price(self):
+        """ Price of the cheapest size or None if catalog is empty """
+        return self.prices[0] if self.prices else None
+
+    def get_cheapest(self, *requirements):
+        """ Return tuple (<size>, <price>) for the cheapest size that satisfies
+            requirements or None if there is no such size.
+        """
+        return self.get_cheapest_many([requirements])[0]
+
+    def get_cheapest_many(self, requirements_list):
+        """ Return list of the cheapest sizes for each requirements tuple """
+        requirements_list = [tuple(requirements) for requirements in requirements_list]
+        missing = list(collections.OrderedDict.fromkeys(
+            requirements for requirements in requirements_list if requirements not in self._cheapest))
+        for start in range(0, len(missing), self.CHUNK_SIZE):
+            chunk = missing[start:start + self.CHUNK_SIZE]
+            if not self.sizes:
+                self._cheapest.update((requirements, None) for requirements in chunk)
+                continue
+            block = numpy.array(chunk, dtype=numpy.int64).reshape(len(chunk), len(self.attributes))
+            suitable = self.columns[0][numpy.newaxis, :] >= block[:, 0, numpy.newaxis]
+            for position in range(1, len(self.columns)):
+                suitable &= self.columns[position][numpy.newaxis, :] >= block[:, position, numpy.newaxis]
+            positions = suitable.argmax(axis=1)
+            found = suitable[numpy.arange(len(chunk)), positions]
+            for requirements, position, is_found in zip(chunk, positions, found):
+                self._cheapest[requirements] = (self.sizes[position], self.prices[position]) if is_found else None
+        return [self._cheapest[requirements] for requirements in requirements_list]
+
+
+def get_size_catalog_index(sizes, get_price, attributes=('cores', 'ram', 'disk')):
+    """ Return vectorized index for large catalogs if NumPy is available, otherwise pure Python index """
+    sizes = list(sizes)
+    if numpy is not None and len(sizes) >= settings.WALDUR_COST_PLANNING['vectorized_index_min_size']:
+        return VectorizedSizeCatalogIndex(sizes, get_price, attributes)
+    return SizeCatalogIndex(sizes, get_price, attributes)
@@ -1,105 +1,154 @@
 """ Defines how to optimize price for OpenStackTenant instances """
 import collections
 
-from django.contrib.contenttypes.models import ContentType
+from django.conf import settings
 from rest_framework import serializers as rf_serializers
 
-from waldur_core.cost_tracking import models as cost_tracking_models
 from waldur_openstack.openstack_tenant import (
     apps as ot_apps, models as ot_models, serializers as ot_serializers, cost_tracking as ot_cost_tracking)
 
-from .. import optimizers, register, serializers
+from .. import catalogs, optimizers, register, serializers
 
 
-OptimizedPreset = collections.namedtuple(
-    'OptimizedPreset', ('preset', 'flavor', 'quantity', 'price', 'flavor_price', 'storage_price'))
+class OptimizedPreset(optimizers.Record):
+    __slots__ = ('preset', 'flavor', 'quantity', 'price', 'flavor_price', 'storage_price')
 
 
-OptimizedOpenStackTenant = optimizers.namedtuple_with_defaults(
-    'OptimizedOpenStack',
-    field_names=optimizers.OptimizedService._fields + ('optimized_presets',),
-    default_values=optimizers.OptimizedService._defaults,
-)
+FlavorCatalog = collections.namedtuple(
+    'FlavorCatalog', ('index', 'unpriced_flavors', 'storage_price', 'priced_flavors'))
+
+
+class OptimizedOpenStackTenant(optimizers.OptimizedService):
+    __slots__ = ('optimized_presets',)
 
 
 class OpenStackTenantOptimizer(optimizers.Optimizer):
     """ Find the cheapest OpenStackTenant flavor for each preset. """
     HOURS_IN_DAY = 24
+    optimized_service_class = OptimizedOpenStackTenant
 
-    def _get_service_price_item(self, service, resource_content_type, item_type, key):
-        default_item = cost_tracking_models.DefaultPriceListItem.objects.get(
-            resource_content_type=resource_content_type, item_type=item_type, key=key)
-        try:
-            return cost_tracking_models.PriceListItem.objects.get(
-                default_price_list_item=default_item, service=service)
-        except cost_tracking_models.PriceListItem.DoesNotExist:
-            return default_item
-
-    def _get_flavor_price(self, service, flavor):
-        instance_content_type = ContentType.objects.get_for_model(ot_models.Instance)
-        try:
-            item = self._get_service_price_item(
-                service=service,
-                resource_content_type=instance_content_type,
-                item_type=ot_cost_tracking.InstanceStrategy.Types.FLAVOR,
-                key=flavor.name,
-            )
-        except cost_tracking_models.DefaultPriceListItem.DoesNotExist:
-            raise optimizers.OptimizationError('Price is not defined for flavor "%s".' % flavor.name)
-        return item.value * self.HOURS_IN_DAY
-
-    def _get_cheapest_flavor(self, service, suitable_flavors):
-        priced_flavors = [(flavor, self._get_flavor_price(service, flavor)) for flavor in suitable_flavors]
-        cheapest_flavor, price = min(priced_flavors, key=lambda x: x[1])
-        return cheapest_flavor, price
-
-    def _get_storage_price(self, service, storage):
-        volume_content_type = ContentType.objects.get_for_model(ot_models.Volume)
-        try:
-            item = self._get_service_price_item(
-                service=service,
-                resource_content_type=volume_content_type,
-                item_type=ot_cost_tracking.VolumeStrategy.Types.STORAGE,
-                key=ot_cost_tracking.VolumeStrategy.Keys.STORAGE,
-            )
-        except cost_tracking_models.DefaultPriceListItem.DoesNotExist:
-            raise optimizers.OptimizationError('Storage price is not defined.')
-        return item.value * self.HOURS_IN_DAY
+    def _get_prices(self, service):
+        """ Return flavor prices as dictionary <flavor name>: <flavor price> and storage price """
+        instance_prices = catalogs.get_service_prices(service, ot_models.Instance)
+        flavor_prices = {key: value * self.HOURS_IN_DAY for (item_type, key), value in instance_prices.items()
+                         if item_type == ot_cost_tracking.InstanceStrategy.Types.FLAVOR}
+
+        volume_prices = catalogs.get_service_prices(service, ot_models.Volume)
+        storage_price = volume_prices.get(
+            (ot_cost_tracking.VolumeStrategy.Types.STORAGE, ot_cost_tracking.VolumeStrategy.Keys.STORAGE))
+        if storage_price is not None:
+            storage_price *= self.HOURS_IN_DAY
+        return flavor_prices, storage_price
 
     def optimize(self, deployment_plan, service):
-        optimized_presets = []
-        price = 0
-        for item in deployment_plan.items.all():
-            preset = item.preset
-            suitable_flavors = ot_models.Flavor.objects.filter(
-                cores__gte=preset.cores, ram__gte=preset.ram, settings=service.settings)
-            if not suitable_flavors:
-                preset_as_str = '%s (cores: %s, ram %s MB, storage %s MB)' % (
-                    preset.name, preset.cores, preset.ram, preset.storage)
+        optimized_service = super(OpenStackTenantOptimizer, self).optimize(deployment_plan, service)
+        if self.quotas is None:
+            return optimized_service
+        return self._fit_quotas(service, optimized_service)
+
+    def _get_capacity(self):
+        """ Return remaining (<cores>, <ram>, <storage>, <instances>) of tenant, None if resource is unlimited """
+        return tuple(self.quotas.get(name) for name in ('vcpu', 'ram', 'storage', 'instances'))
+
+    def _fit_quotas(self, service, optimized_service):
+        """ Return the cheapest setup that fits remaining quotas of tenant or raise OptimizationError """
+        capacity = self._get_capacity()
+        optimized_presets = optimized_service.optimized_presets
+        usage = [(preset.flavor.cores, preset.flavor.ram, preset.preset.storage, 1) for preset in optimized_presets]
+        totals = [sum(resources[position] * preset.quantity for resources, preset in zip(usage, optimized_presets))
+                  for position in range(len(capacity))]
+        if all(amount is None or total <= amount for total, amount in zip(totals, capacity)):
+            return optimized_service
+
+        catalog = self._get_catalog(service)
+        items = [(optimized_preset.quantity, [
+            (flavor_price + catalog.storage_price, (flavor.cores, flavor.ram, optimized_preset.preset.storage, 1),
+             (flavor, flavor_price))
+            for flavor, flavor_price in catalog.priced_flavors
+            if flavor.cores >= optimized_preset.preset.cores and flavor.ram >= optimized_preset.preset.ram
+        ]) for optimized_preset in optimized_presets]
+
+        packer = optimizers.CapacityPacker(
+            items, capacity, time_budget=settings.WALDUR_COST_PLANNING['capacity_time_budget'])
+        choices = packer.solve()
+        self.stats['capacity_nodes'] = packer.nodes
+        self.stats['capacity_timed_out'] = packer.timed_out
+        if choices is None:
+            if packer.timed_out:
                 raise optimizers.OptimizationError(
-                    'It is impossible to create an instance for preset %s. It is too big.' % preset_as_str)
-
-            flavor, flavor_price = self._get_cheapest_flavor(service, suitable_flavors)
-            storage_price = self._get_storage_price(service, preset.storage)
-            preset_price = flavor_price + storage_price
-            optimized_presets.append(OptimizedPreset(
-                preset=preset,
-                flavor=flavor,
-                quantity=item.quantity,
-                flavor_price=flavor_price,
-                storage_price=storage_price,
-                price=preset_price * item.quantity,
-            ))
-            price += preset_price * item.quantity
-        return OptimizedOpenStackTenant(price=price, service=service, optimized_presets=optimized_presets)
+                    'Unable to find setup that fits remaining quotas of tenant in time.')
+            shortage = packer.get_shortage()
+            if shortage:
+                names = ('cores', 'RAM', 'storage', 'instances')
+                details = ', '.join('%s: required at least %s, available %s' % (names[dimension], required, available)
+                                    for dimension, required, available in shortage)
+                raise optimizers.OptimizationError(
+                    'Remaining quotas of tenant are not enough for deployment plan (%s).' % details)
+            raise optimizers.OptimizationError(
+                'There is no combination of flavors that fits remaining quotas of tenant.')
+
+        optimized_presets = [self.get_optimized_preset(optimized_preset, (flavor, flavor_price, catalog.storage_price))
+                             for optimized_preset, (flavor, flavor_price) in zip(optimized_presets, choices)]
+        return self.optimized_service_class(
+            service=service,
+            price=sum(optimized_preset.price for optimized_preset in optimized_presets),
+            optimized_presets=optimized_presets,
+        )
+
+    def get_catalog(self, service):
+        flavor_prices, storage_price = self._get_prices(service)
+        flavors = ot_models.Flavor.objects.filter(settings=service.settings)
+        priced_flavors = [flavor for flavor in flavors if flavor.name in flavor_prices]
+        unpriced_flavors = [flavor for flavor in flavors if flavor.name not in flavor_prices]
+        index = optimizers.get_size_catalog_index(
+            priced_flavors, get_price=lambda flavor: flavor_prices[flavor.name], attributes=('cores', 'ram'))
+        return FlavorCatalog(index=index, unpriced_flavors=unpriced_flavors, storage_price=storage_price,
+                             priced_flavors=[(flavor, flavor_prices[flavor.name]) for flavor in priced_flavors])
+
+    def get_index(self, catalog):
+        return catalog.index
+
+    def get_index_requirements(self, preset):
+        return preset.cores, preset.ram
+
+    def get_min_price(self, catalog):
+        if catalog.index.min_price is None or catalog.storage_price is None:
+            return None
+        return catalog.index.min_price + catalog.storage_price
+
+    def get_cheapest_choice(self, catalog, preset):
+        for flavor in catalog.unpriced_flavors:
+            if flavor.cores >= preset.cores and flavor.ram >= preset.ram:
+                raise optimizers.OptimizationError('Price is not defined for flavor "%s".' % flavor.name)
+        cheapest = catalog.index.get_cheapest(preset.cores, preset.ram)
+        if cheapest is None:
+            preset_as_str = '%s (cores: %s, ram %s MB, storage %s MB)' % (
+                preset.name, preset.cores, preset.ram, preset.storage)
+            raise optimizers.OptimizationError(
+                'It is impossible to create an instance for preset %s. It is too big.' % preset_as_str)
+        if catalog.storage_price is None:
+            raise optimizers.OptimizationError('Storage price is not defined.')
+        flavor, flavor_price = cheapest
+        return flavor, flavor_price, catalog.storage_price
+
+    def get_optimized_preset(self, item, choice):
+        flavor, flavor_price, storage_price = choice
+        return OptimizedPreset(
+            preset=item.preset,
+            flavor=flavor,
+            quantity=item.quantity,
+            flavor_price=flavor_price,
+            storage_price=storage_price,
+            price=(flavor_price + storage_price) * item.quantity,
+        )
 
 
 register.Register.register_optimizer(ot_apps.OpenStackTenantConfig.service_name, OpenStackTenantOptimizer)
 
 
 class OptimizedPresetSerializer(rf_serializers.Serializer):
-    flavor = ot_serializers.FlavorSerializer()
-    preset = serializers.PresetSerializer()
+    flavor = serializers.FragmentField(ot_serializers.FlavorSerializer)
+    preset = serializers.FragmentField(serializers.PresetSerializer)
     quantity = rf_serializers.IntegerField()
     flavor_price = rf_serializers.DecimalField(max_digits=22, decimal_places=10)
     storage_price = rf_serializers.DecimalField(max_digits=22, decimal_places=10)
@@ -107,11 +156,7 @@ class OptimizedPresetSerializer(rf_serializers.Serializer):
 
 
 class OptimizedOpenStackTenantSerializer(serializers.OptimizedServiceSerializer):
-    service = rf_serializers.HyperlinkedRelatedField(
-        view_name='openstacktenant-detail',
-        lookup_field='uuid',
-        read_only=True,
-    )
+    service = serializers.UUIDHyperlinkField(view_name='openstacktenant-detail', source='service_uuid')
     optimized_presets = OptimizedPresetSerializer(many=True)
 
 
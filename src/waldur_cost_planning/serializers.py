@@ -1,12 +1,14 @@
 from __future__ import unicode_literals
 
 from django.db import transaction
+from django.db.models import Case, PositiveSmallIntegerField, Value, When
 from rest_framework import serializers
+from rest_framework.reverse import reverse
 
 from waldur_core.core import serializers as core_serializers
 from waldur_core.structure import permissions as structure_permissions, models as structure_models
 
-from . import models, register
+from . import models, optimizers, register
 
 
 class PresetSerializer(serializers.HyperlinkedModelSerializer):
@@ -78,10 +80,12 @@ class DeploymentPlanCreateSerializer(BaseDeploymentPlanSerializer):
     def create(self, validated_data):
         items = validated_data.pop('items', [])
         certifications = validated_data.pop('certifications', [])
-        plan = super(DeploymentPlanCreateSerializer, self).create(validated_data)
-        for item in items:
-            plan.items.create(**item)
-        plan.certifications.add(*certifications)
+        with transaction.atomic():
+            plan = super(DeploymentPlanCreateSerializer, self).create(validated_data)
+            models.DeploymentPlanItem.objects.bulk_create(
+                models.DeploymentPlanItem(plan=plan, **item) for item in items)
+            plan.update_requirements()
+            plan.certifications.add(*certifications)
         return plan
 
     def update(self, instance, validated_data):
@@ -94,53 +98,147 @@ class DeploymentPlanCreateSerializer(BaseDeploymentPlanSerializer):
             with transaction.atomic():
                 plan.certifications.clear()
                 plan.certifications.add(*certifications)
+            # Suitable services may change, so plan is evaluated from scratch
+            optimizers.PartialResults.clear(plan.uuid.hex)
 
         if items is None:
             return plan
 
-        current_map = {item.preset_id: item.quantity for item in plan.items.all()}
+        current_map = dict(plan.items.values_list('preset_id', 'quantity'))
         current_ids = set(current_map.keys())
 
         new_map = {item['preset'].id: item['quantity'] for item in items}
         new_ids = set(new_map.keys())
 
+        changed_map = {item_id: new_map[item_id] for item_id in new_ids & current_ids
+                       if new_map[item_id] != current_map[item_id]}
+
         with transaction.atomic():
             # Remove stale items
-            plan.items.filter(preset_id__in=current_ids - new_ids).delete()
+            if current_ids - new_ids:
+                plan.items.filter(preset_id__in=current_ids - new_ids).delete()
 
             # Create new items
-            for item_id in new_ids - current_ids:
-                plan.items.create(preset_id=item_id, quantity=new_map[item_id])
+            models.DeploymentPlanItem.objects.bulk_create(
+                models.DeploymentPlanItem(plan=plan, preset_id=item_id, quantity=new_map[item_id])
+                for item_id in new_ids - current_ids)
+
+            # Update existing items which quantity is changed
+            if changed_map:
+                plan.items.filter(preset_id__in=list(changed_map)).update(quantity=Case(
+                    *[When(preset_id=item_id, then=Value(quantity)) for item_id, quantity in changed_map.items()],
+                    output_field=PositiveSmallIntegerField()
+                ))
+
+            plan.update_requirements()
+
+        # Choices for remaining presets are reused by next evaluation
+        optimizers.PartialResults.prune(
+            plan.uuid.hex, {optimizers.get_preset_requirements(item['preset']) for item in items})
+        return plan
 
-            # Update existing items
-            for item_id in new_ids & current_ids:
-                plan.items.filter(preset_id=item_id).update(quantity=new_map[item_id])
 
-        return plan
+class UUIDHyperlinkField(serializers.ReadOnlyField):
+    """ Render hyperlink to object by its UUID, so object itself is not loaded """
+
+    def __init__(self, view_name, **kwargs):
+        self.view_name = view_name
+        super(UUIDHyperlinkField, self).__init__(**kwargs)
+
+    def to_representation(self, uuid):
+        return reverse(self.view_name, kwargs={'uuid': uuid}, request=self.context.get('request'))
+
+
+class FragmentField(serializers.Field):
+    """ Render nested object with given serializer once for serializer context.
+
+        The same presets, sizes and flavors recur in results of every service,
+        so their representations, including hyperlinks, are rendered once
+        and reused by all serializers that share the context.
+    """
+
+    def __init__(self, serializer_class, **kwargs):
+        self.serializer_class = serializer_class
+        kwargs['read_only'] = True
+        super(FragmentField, self).__init__(**kwargs)
+
+    def to_representation(self, instance):
+        fragments = self.context.setdefault('fragments', {})
+        key = (self.serializer_class, instance.__class__, instance.pk)
+        if key not in fragments:
+            fragments[key] = self.serializer_class(context=self.context).to_representation(instance)
+        return fragments[key]
 
 
 class OptimizedServiceSummarySerializer(serializers.Serializer):
-    """ Serializer that renders each instance with its own specific serializer """
+    """ Serializer that renders each instance with its own specific serializer.
+        Serializer of each type is created once and reused for all instances.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(OptimizedServiceSummarySerializer, self).__init__(*args, **kwargs)
+        self._serializers = {}
 
     @classmethod
     def get_serializer(cls, optimized_service):
         if optimized_service.error_message:
             return OptimizedServiceSerializer
-        return register.Register.get_serilizer(optimized_service.service.settings.type) or OptimizedServiceSerializer
+        return register.Register.get_serilizer(optimized_service.settings_type) or OptimizedServiceSerializer
 
     def to_representation(self, instance):
-        serializer = self.get_serializer(instance)
-        return serializer(instance, context=self.context).data
+        serializer_class = self.get_serializer(instance)
+        if serializer_class not in self._serializers:
+            self._serializers[serializer_class] = serializer_class(context=self.context)
+        return self._serializers[serializer_class].to_representation(instance)
 
 
 class OptimizedServiceSerializer(serializers.Serializer):
     price = serializers.DecimalField(max_digits=22, decimal_places=10)
-    service_settings = serializers.HyperlinkedRelatedField(
-        source='service.settings',
-        view_name='servicesettings-detail',
-        lookup_field='uuid',
-        read_only=True,
-    )
-    service_settings_name = serializers.ReadOnlyField(source='service.settings.name')
-    service_settings_type = serializers.ReadOnlyField(source='service.settings.type')
+    service_settings = UUIDHyperlinkField(view_name='servicesettings-detail', source='settings_uuid')
+    service_settings_name = serializers.ReadOnlyField(source='settings_name')
+    service_settings_type = serializers.ReadOnlyField(source='settings_type')
     error_message = serializers.ReadOnlyField()
+
+
+class DeploymentPlanEvaluateQuerySerializer(serializers.Serializer):
+    limit = serializers.IntegerField(min_value=1, required=False)
+    max_price = serializers.DecimalField(max_digits=22, decimal_places=10, min_value=0, required=False)
+    strategy = serializers.ChoiceField(choices=list(optimizers.STRATEGIES), default='single')
+    capacity = serializers.BooleanField(default=False)
+    stream = serializers.BooleanField(default=False)
+
+    def validate(self, attrs):
+        if attrs['strategy'] != 'single' and ('limit' in attrs or 'max_price' in attrs or attrs['capacity']):
+            raise serializers.ValidationError(
+                'Limit, max price and capacity are supported only by "single" strategy.')
+        return attrs
+
+
+class DeploymentPlanBatchEvaluateSerializer(serializers.Serializer):
+    plans = serializers.ListField(child=serializers.UUIDField())
+
+
+class DeploymentPlanEvaluationSerializer(serializers.Serializer):
+    url = serializers.SerializerMethodField()
+    uuid = serializers.ReadOnlyField(source='plan.uuid.hex')
+    name = serializers.ReadOnlyField(source='plan.name')
+    services = serializers.ReadOnlyField()
+
+    def get_url(self, evaluation):
+        return reverse('deployment-plan-detail', kwargs={'uuid': evaluation['plan'].uuid.hex},
+                       request=self.context['request'])
+
+
+class EvaluationJobSerializer(serializers.Serializer):
+    uuid = serializers.ReadOnlyField()
+    url = serializers.SerializerMethodField()
+    deployment_plan = serializers.SerializerMethodField()
+    state = serializers.ReadOnlyField()
+    result = serializers.ReadOnlyField()
+    error_message = serializers.ReadOnlyField()
+
+    def get_url(self, job):
+        return reverse('deployment-plan-evaluation-detail', kwargs={'uuid': job.uuid}, request=self.context['request'])
+
+    def get_deployment_plan(self, job):
+        return reverse('deployment-plan-detail', kwargs={'uuid': job.plan_uuid}, request=self.context['request'])
@@ -0,0 +1,12 @@
+from __future__ import unicode_literals
+
+from celery import shared_task
+
+from . import evaluations
+
+
+@shared_task(name='waldur_cost_planning.evaluate_deployment_plan')
+def evaluate_deployment_plan(job_uuid):
+    job = evaluations.EvaluationJob.get(job_uuid)
+    if job is not None:
+        job.run()
@@ -0,0 +1,298 @@
+""" Performance benchmarks of cost planning.
+
+Benchmarks are not run by default, set WALDUR_COST_PLANNING_BENCHMARKS
+environment variable to run them, for example:
+
+    WALDUR_COST_PLANNING_BENCHMARKS=1 waldur test waldur_cost_planning.tests.benchmarks
+
+They use database configured in Django settings, so the same suite runs
+against SQLite and PostgreSQL. Results of optimization benchmarks are
+compared with baseline of the database vendor stored next to this module,
+for example benchmarks_baseline_sqlite.json. Baseline is not shipped,
+because timings depend on the machine, create it before making changes:
+
+    WALDUR_COST_PLANNING_BENCHMARKS=1 WALDUR_COST_PLANNING_BENCHMARKS_UPDATE=1 \
+        waldur test waldur_cost_planning.tests.benchmarks.EvaluationBenchmark
+
+Peak memory is measured with tracemalloc if it is available. Otherwise, for
+example on Python 2.7, growth of peak resident set size of the process is
+reported, which is coarser and is zero if process has already used more memory.
+"""
+from __future__ import print_function
+
+import collections
+import json
+import os
+import random
+import sys
+import time
+import unittest
+
+from django.contrib.contenttypes.models import ContentType
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from rest_framework import test
+
+from waldur_core.cost_tracking import models as ct_models
+from waldur_core.cost_tracking.tests import factories as ct_factories
+from waldur_openstack.openstack_tenant import models as ot_models, cost_tracking as ot_cost_tracking
+from waldur_openstack.openstack_tenant.tests import factories as ot_factories
+
+from . import factories, fixtures
+from .. import catalogs, optimizers
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+Size = collections.namedtuple('Size', ('name', 'cores', 'ram', 'disk', 'price'))
+
+BENCHMARKS_ENABLED = bool(os.environ.get('WALDUR_COST_PLANNING_BENCHMARKS'))
+BASELINE_UPDATE = bool(os.environ.get('WALDUR_COST_PLANNING_BENCHMARKS_UPDATE'))
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), 'benchmarks_baseline_%s.json')
+# Wall time may grow by this factor before it is reported as regression
+TIME_TOLERANCE = 1.5
+
+
+def generate_sizes(count, seed=0):
+    """ Return sizes which price grows with resources, so most of them are not dominated """
+    generator = random.Random(seed)
+    sizes = []
+    for i in range(count):
+        cores = generator.randint(1, 64)
+        ram = generator.randint(1, 512) * 1024
+        disk = generator.randint(1, 200) * 10 * 1024
+        price = cores * 10 + ram / 1024.0 + disk / 10240.0 + generator.uniform(0, 50)
+        sizes.append(Size('size-%s' % i, cores, ram, disk, price))
+    return sizes
+
+
+def generate_requirements(count, seed=0):
+    generator = random.Random(seed)
+    return [(generator.randint(1, 48), generator.randint(1, 384) * 1024, generator.randint(1, 150) * 10 * 1024)
+            for _ in range(count)]
+
+
+class LinearSearch(object):
+    """ Search that optimizers used before size index was introduced:
+        all sizes are filtered for each preset and the cheapest one is chosen.
+    """
+
+    def __init__(self, sizes, get_price):
+        self.sizes = sizes
+        self.prices = {size: get_price(size) for size in sizes}
+
+    def get_cheapest_many(self, requirements_list):
+        result = []
+        for cores, ram, disk in requirements_list:
+            sizes = [size for size in self.sizes if size.cores >= cores and size.ram >= ram and size.disk >= disk]
+            if not sizes:
+                result.append(None)
+                continue
+            size = min(sizes, key=lambda size: self.prices[size])
+            result.append((size, self.prices[size]))
+        return result
+
+
+def measure(index_class, sizes, requirements):
+    """ Return tuple (<result>, <seconds spent on building index and solving all requirements>) """
+    started = time.time()
+    index = index_class(sizes, get_price=lambda size: size.price)
+    result = index.get_cheapest_many(requirements)
+    return result, time.time() - started
+
+
+@unittest.skipUnless(BENCHMARKS_ENABLED, 'Benchmarks are disabled.')
+class SizeCatalogIndexBenchmark(unittest.TestCase):
+    CASES = (
+        (1000, 100),
+        (2000, 200),
+        (5000, 500),
+    )
+
+    def test_index_is_faster_than_linear_search(self):
+        for sizes_count, presets_count in self.CASES:
+            sizes = generate_sizes(sizes_count)
+            requirements = generate_requirements(presets_count)
+
+            expected, linear_time = measure(LinearSearch, sizes, requirements)
+            result, index_time = measure(optimizers.SizeCatalogIndex, sizes, requirements)
+
+            print('\nSizes: %s, presets: %s, linear search: %.3fs, index: %.3fs, speedup: %.1fx' % (
+                sizes_count, presets_count, linear_time, index_time, linear_time / index_time))
+            self.assertEqual(result, expected)
+            self.assertLess(index_time, linear_time)
+
+    @unittest.skipIf(optimizers.numpy is None, 'NumPy is not installed.')
+    def test_vectorized_index_is_faster_than_linear_search(self):
+        for sizes_count, presets_count in self.CASES:
+            sizes = generate_sizes(sizes_count)
+            requirements = generate_requirements(presets_count)
+
+            expected, linear_time = measure(LinearSearch, sizes, requirements)
+            _, python_time = measure(optimizers.SizeCatalogIndex, sizes, requirements)
+            result, numpy_time = measure(optimizers.VectorizedSizeCatalogIndex, sizes, requirements)
+
+            print('\nSizes: %s, presets: %s, linear search: %.3fs, Python index: %.3fs, NumPy index: %.3fs, '
+                  'speedup: %.1fx' % (sizes_count, presets_count, linear_time, python_time, numpy_time,
+                                      linear_time / numpy_time))
+            self.assertEqual(result, expected)
+            self.assertLess(numpy_time, linear_time)
+
+
+Case = collections.namedtuple('Case', ('services', 'flavors', 'presets', 'items'))
+
+
+def get_max_rss():
+    """ Return peak resident set size of the process in bytes or None if it is unknown """
+    if resource is None:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # It is reported in bytes on macOS and in kilobytes on Linux
+    return max_rss if sys.platform == 'darwin' else max_rss * 1024
+
+
+def measure_call(func):
+    """ Return tuple (<result>, <metrics>) where metrics contain wall time,
+        number of database queries and peak memory allocated during call.
+    """
+    if tracemalloc is not None:
+        tracemalloc.start()
+    initial_rss = get_max_rss()
+    started = time.time()
+    with CaptureQueriesContext(connection) as queries:
+        result = func()
+    metrics = {
+        'wall_time': time.time() - started,
+        'queries': len(queries),
+        'peak_memory': None,
+    }
+    if tracemalloc is not None:
+        metrics['peak_memory'] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    elif initial_rss is not None:
+        metrics['peak_memory'] = get_max_rss() - initial_rss
+    return result, metrics
+
+
+def get_baseline_path():
+    return BASELINE_PATH % connection.vendor
+
+
+def load_baseline():
+    if not os.path.exists(get_baseline_path()):
+        return {}
+    with open(get_baseline_path()) as baseline_file:
+        return json.load(baseline_file)
+
+
+def save_baseline(baseline):
+    with open(get_baseline_path(), 'w') as baseline_file:
+        json.dump(baseline, baseline_file, indent=2, sort_keys=True)
+
+
+@unittest.skipUnless(BENCHMARKS_ENABLED, 'Benchmarks are disabled.')
+class EvaluationBenchmark(test.APITransactionTestCase):
+    CASES = (
+        Case(services=1, flavors=10, presets=10, items=10),
+        Case(services=5, flavors=100, presets=50, items=20),
+        Case(services=10, flavors=200, presets=100, items=100),
+    )
+
+    @classmethod
+    def setUpClass(cls):
+        super(EvaluationBenchmark, cls).setUpClass()
+        cls.baseline = load_baseline()
+        cls.results = {}
+
+    @classmethod
+    def tearDownClass(cls):
+        if BASELINE_UPDATE:
+            baseline = load_baseline()
+            baseline.update(cls.results)
+            save_baseline(baseline)
+        super(EvaluationBenchmark, cls).tearDownClass()
+
+    def setUp(self):
+        self.instance_content_type = ContentType.objects.get_for_model(ot_models.Instance)
+        ct_factories.DefaultPriceListItemFactory(
+            resource_content_type=ContentType.objects.get_for_model(ot_models.Volume),
+            item_type=ot_cost_tracking.VolumeStrategy.Types.STORAGE,
+            key=ot_cost_tracking.VolumeStrategy.Keys.STORAGE,
+        )
+
+    def build(self, case):
+        """ Create project with services, flavors and deployment plan of given size """
+        generator = random.Random(0)
+        fixture = fixtures.CostPlanningFixture()
+        for _ in range(case.services):
+            spl = ot_factories.OpenStackTenantServiceProjectLinkFactory(project=fixture.project)
+            for _ in range(case.flavors):
+                flavor = ot_factories.FlavorFactory(
+                    settings=spl.service.settings,
+                    cores=generator.randint(1, 64),
+                    ram=generator.randint(1, 256) * 1024,
+                )
+                ct_models.DefaultPriceListItem.objects.create(
+                    resource_content_type=self.instance_content_type,
+                    item_type=ot_cost_tracking.InstanceStrategy.Types.FLAVOR,
+                    key=flavor.name,
+                    value=flavor.cores + flavor.ram / 1024.0 + generator.uniform(0, 10),
+                )
+
+        presets = [factories.PresetFactory(
+            category=fixture.category,
+            cores=generator.randint(1, 16),
+            ram=generator.randint(1, 64) * 1024,
+            storage=generator.randint(1, 100) * 1024,
+        ) for _ in range(case.presets)]
+        for preset in presets[:case.items]:
+            factories.DeploymentPlanItemFactory(plan=fixture.deployment_plan, preset=preset, quantity=1)
+        return fixture
+
+    def report(self, name, metrics):
+        self.results[name] = metrics
+        baseline = self.baseline.get(name)
+        message = '\n%s: %.3fs, %s queries, peak memory: %s' % (
+            name, metrics['wall_time'], metrics['queries'], metrics['peak_memory'])
+        if baseline:
+            message += ' (baseline: %.3fs, %s queries, peak memory: %s)' % (
+                baseline['wall_time'], baseline['queries'], baseline['peak_memory'])
+            if metrics['wall_time'] > baseline['wall_time'] * TIME_TOLERANCE:
+                message += ' WALL TIME REGRESSION'
+        elif not BASELINE_UPDATE:
+            message += ' (no baseline in %s)' % get_baseline_path()
+        print(message)
+
+        if baseline and not BASELINE_UPDATE:
+            self.assertLessEqual(metrics['queries'], baseline['queries'], 'Number of queries has grown for %s.' % name)
+
+    def test_optimization(self):
+        for case in self.CASES:
+            fixture = self.build(case)
+            catalogs.bump_version()
+            strategy = optimizers.SingleServiceStrategy(fixture.deployment_plan)
+
+            optimized, metrics = measure_call(strategy.get_optimized)
+
+            self.assertEqual(len(optimized), case.services)
+            self.report('optimization-%s-services-%s-flavors-%s-presets-%s-items' % case, metrics)
+
+    def test_evaluate_request(self):
+        for case in self.CASES:
+            fixture = self.build(case)
+            catalogs.bump_version()
+            self.client.force_authenticate(fixture.staff)
+            url = factories.DeploymentPlanFactory.get_url(fixture.deployment_plan, action='evaluate')
+
+            response, metrics = measure_call(lambda: self.client.get(url))
+
+            self.assertEqual(response.status_code, 200)
+            self.report('evaluate-%s-services-%s-flavors-%s-presets-%s-items' % case, metrics)
@@ -16,8 +16,9 @@ class DeploymentPlanFactory(factory.DjangoModelFactory):
     project = factory.SubFactory(structure_factories.ProjectFactory)
 
     @classmethod
-    def get_list_url(cls):
-        return 'http://testserver' + reverse('deployment-plan-list')
+    def get_list_url(cls, action=None):
+        url = 'http://testserver' + reverse('deployment-plan-list')
+        return url if not action else url + action + '/'
 
     @classmethod
     def get_url(cls, obj, action=None):
@@ -0,0 +1,101 @@
+import mock
+from django.contrib.contenttypes.models import ContentType
+from rest_framework import test
+
+from waldur_core.cost_tracking.tests import factories as ct_factories
+from waldur_openstack.openstack_tenant import models as ot_models
+
+from . import fixtures
+from .. import catalogs
+
+
+class PriceCatalogTest(test.APITransactionTestCase):
+    def setUp(self):
+        self.fixture = fixtures.CostPlanningOpenStackPluginFixture()
+        self.service = self.fixture.spl.service
+        self.default_item = ct_factories.DefaultPriceListItemFactory(
+            resource_content_type=ContentType.objects.get_for_model(ot_models.Instance),
+            item_type='flavor',
+            key='small',
+            value=10,
+        )
+
+    def test_prices_are_loaded_from_cache(self):
+        prices = catalogs.get_service_prices(self.service, ot_models.Instance)
+
+        with self.assertNumQueries(0):
+            self.assertEqual(catalogs.get_service_prices(self.service, ot_models.Instance), prices)
+
+    def test_prices_are_invalidated_when_price_list_item_is_changed(self):
+        catalogs.get_service_prices(self.service, ot_models.Instance)
+
+        self.default_item.value = 20
+        self.default_item.save()
+
+        prices = catalogs.get_service_prices(self.service, ot_models.Instance)
+        self.assertEqual(prices[('flavor', 'small')], 20)
+
+    def test_prices_are_invalidated_when_price_list_item_is_deleted(self):
+        catalogs.get_service_prices(self.service, ot_models.Instance)
+
+        self.default_item.delete()
+
+        prices = catalogs.get_service_prices(self.service, ot_models.Instance)
+        self.assertNotIn(('flavor', 'small'), prices)
+
+
+class ServiceCatalogTest(test.APITransactionTestCase):
+    def setUp(self):
+        self.service = fixtures.CostPlanningOpenStackPluginFixture().spl.service
+        self.load = mock.Mock(side_effect=lambda service: object())
+
+    def test_catalog_is_built_once(self):
+        catalog = catalogs.get_service_catalog(self.service, self.load)
+
+        self.assertIs(catalogs.get_service_catalog(self.service, self.load), catalog)
+        self.assertEqual(self.load.call_count, 1)
+
+    def test_catalog_is_rebuilt_when_catalog_version_is_changed(self):
+        catalog = catalogs.get_service_catalog(self.service, self.load)
+        catalogs.bump_version()
+
+        self.assertIsNot(catalogs.get_service_catalog(self.service, self.load), catalog)
+        self.assertEqual(self.load.call_count, 2)
+
+
+class LRUCacheTest(test.APISimpleTestCase):
+    def test_least_recently_used_entry_is_evicted(self):
+        cache = catalogs.LRUCache(maxsize=2, ttl=60)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+
+        self.assertEqual(cache.get('a'), 1)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('c'), 3)
+
+    def test_expired_entry_is_not_returned(self):
+        cache = catalogs.LRUCache(maxsize=2, ttl=-1)
+        cache.set('a', 1)
+
+        self.assertIsNone(cache.get('a'))
+
+
+class ProviderSizesTest(test.APISimpleTestCase):
+    def setUp(self):
+        self.load = mock.Mock(return_value=['small', 'large'])
+
+    def test_sizes_are_loaded_once(self):
+        catalogs.get_provider_sizes(self.id(), self.load)
+        sizes = catalogs.get_provider_sizes(self.id(), self.load)
+
+        self.assertEqual(sizes, ('small', 'large'))
+        self.assertEqual(self.load.call_count, 1)
+
+    def test_sizes_are_reloaded_when_catalog_version_is_changed(self):
+        catalogs.get_provider_sizes(self.id(), self.load)
+        catalogs.bump_version()
+        catalogs.get_provider_sizes(self.id(), self.load)
+
+        self.assertEqual(self.load.call_count, 2)
@@ -1,10 +1,18 @@
+import json
+
+import mock
 from ddt import ddt, data
+from django.conf import settings
+from django.contrib import admin as django_admin
+from django.db import connection
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
 from rest_framework import status, test
 
 from waldur_core.structure.tests import factories as structure_factories
 
 from . import factories, fixtures
-from .. import models
+from .. import admin, models, serializers
 
 
 @ddt
@@ -32,6 +40,40 @@ class DeploymentPlanListTest(test.APITransactionTestCase):
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertEqual(len(response.data), 0)
 
+    def test_deployment_plans_can_be_filtered_by_required_cores(self):
+        plan = factories.DeploymentPlanFactory(project=self.fixture.project)
+        plan.items.create(preset=factories.PresetFactory(cores=8), quantity=10)
+        plan.update_requirements()
+        self.client.force_authenticate(self.fixture.staff)
+
+        response = self.client.get(factories.DeploymentPlanFactory.get_list_url(), {'cores__gte': 65})
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([item['name'] for item in response.data], [plan.name])
+
+    def test_queries_count_does_not_depend_on_plans_count(self):
+        self.create_plans(2)
+        self.client.force_authenticate(self.fixture.staff)
+        self.client.get(factories.DeploymentPlanFactory.get_list_url())
+
+        with CaptureQueriesContext(connection) as initial_queries:
+            response = self.client.get(factories.DeploymentPlanFactory.get_list_url())
+        self.assertEqual(len(response.data), 3)
+
+        self.create_plans(5)
+        with CaptureQueriesContext(connection) as final_queries:
+            response = self.client.get(factories.DeploymentPlanFactory.get_list_url())
+        self.assertEqual(len(response.data), 8)
+
+        self.assertEqual(len(initial_queries), len(final_queries))
+
+    def create_plans(self, count):
+        for _ in range(count):
+            plan = factories.DeploymentPlanFactory(project=self.fixture.project)
+            plan.certifications.add(structure_factories.ServiceCertificationFactory())
+            for _ in range(3):
+                factories.DeploymentPlanItemFactory(plan=plan)
+
     def get_deployment_plans(self, user):
         self.client.force_authenticate(user=user)
         response = self.client.get(factories.DeploymentPlanFactory.get_list_url())
@@ -104,6 +146,44 @@ class DeploymentPlanUpdateTest(test.APITransactionTestCase):
         self.assertEqual(self.plan.items.count(), 1)
         self.assertEqual(self.plan.items.first().quantity, item['quantity'])
 
+    def test_items_are_synchronized_with_constant_number_of_queries(self):
+        presets = [factories.PresetFactory() for _ in range(20)]
+
+        # Each update removes, creates and changes different number of items
+        with CaptureQueriesContext(connection) as initial_queries:
+            self.update_items([(self.preset2, 3)] + [(preset, 1) for preset in presets[:11]])
+
+        with CaptureQueriesContext(connection) as final_queries:
+            self.update_items([(self.preset2, 4), (presets[10], 1)] + [(preset, 2) for preset in presets[11:]])
+
+        self.assertEqual(len(initial_queries), len(final_queries))
+        self.assertEqual(self.plan.items.count(), 11)
+        self.assertEqual(self.plan.items.get(preset=self.preset2).quantity, 4)
+        self.assertFalse(self.plan.items.filter(preset=presets[0]).exists())
+
+    def test_unchanged_items_are_not_updated(self):
+        with CaptureQueriesContext(connection) as unchanged_queries:
+            self.update_items([(self.preset1, 1), (self.preset2, 2)])
+
+        with CaptureQueriesContext(connection) as changed_queries:
+            self.update_items([(self.preset1, 1), (self.preset2, 5)])
+
+        self.assertEqual(len(changed_queries), len(unchanged_queries) + 1)
+        self.assertEqual(self.plan.items.get(preset=self.preset2).quantity, 5)
+
+    def test_requirements_are_updated_with_items(self):
+        preset = factories.PresetFactory(cores=2, ram=2048, storage=10240)
+        self.update_items([(preset, 3)])
+
+        self.plan.refresh_from_db()
+        self.assertEqual(self.plan.get_requirements(), {'ram': 6144, 'cores': 6, 'storage': 30720})
+
+    def update_items(self, items):
+        serializer = serializers.DeploymentPlanCreateSerializer()
+        serializer.update(self.plan, {
+            'items': [{'preset': preset, 'quantity': quantity} for preset, quantity in items]
+        })
+
     @data('global_support')
     def test_user_without_permissions_cannot_update_plan(self, user):
         self.client.force_authenticate(user=getattr(self.fixture, user))
@@ -123,6 +203,51 @@ class DeploymentPlanUpdateTest(test.APITransactionTestCase):
         self.assertEqual(self.plan.name, 'New name for plan')
 
 
+class DeploymentPlanRequirementsTest(test.APITransactionTestCase):
+    def setUp(self):
+        self.plan = factories.DeploymentPlanFactory()
+        self.preset = factories.PresetFactory(cores=2, ram=2048, storage=10240)
+        self.plan.items.create(preset=self.preset, quantity=3)
+        self.plan.items.create(preset=factories.PresetFactory(cores=1, ram=1024, storage=1024), quantity=1)
+        self.plan.update_requirements()
+
+    def test_requirements_are_updated_when_preset_resources_are_changed(self):
+        self.preset.cores = 4
+        self.preset.save()
+
+        self.plan.refresh_from_db()
+        self.assertEqual(self.plan.get_requirements(), {'ram': 7168, 'cores': 13, 'storage': 31744})
+
+    def test_plans_are_not_updated_when_preset_is_renamed(self):
+        self.preset.name = 'Renamed preset'
+
+        with CaptureQueriesContext(connection) as queries:
+            self.preset.save()
+
+        self.assertEqual(len(queries), 1)
+
+    def test_requirements_are_updated_when_preset_is_deleted(self):
+        self.preset.delete()
+
+        self.plan.refresh_from_db()
+        self.assertEqual(self.plan.get_requirements(), {'ram': 1024, 'cores': 1, 'storage': 1024})
+
+    def test_requirements_are_zero_when_last_preset_is_deleted(self):
+        models.Preset.objects.filter(deploymentplanitem__plan=self.plan).delete()
+
+        self.plan.refresh_from_db()
+        self.assertEqual(self.plan.get_requirements(), {'ram': 0, 'cores': 0, 'storage': 0})
+
+    def test_requirements_are_updated_when_plan_is_saved_in_admin(self):
+        self.plan.items.create(preset=factories.PresetFactory(cores=8, ram=8192, storage=8192), quantity=1)
+        model_admin = admin.DeploymentPlanAdmin(models.DeploymentPlan, django_admin.site)
+
+        model_admin.save_related(request=None, form=mock.Mock(instance=self.plan), formsets=[], change=True)
+
+        self.plan.refresh_from_db()
+        self.assertEqual(self.plan.get_requirements(), {'ram': 15360, 'cores': 15, 'storage': 39936})
+
+
 @ddt
 class DeploymentPlanDeleteTest(test.APITransactionTestCase):
 
@@ -173,3 +298,232 @@ class DeploymentPlanEvaluateTest(test.APITransactionTestCase):
         response = self.client.get(self.url)
 
         self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_evaluation_response_contains_etag_and_last_modified_headers(self):
+        self.client.force_authenticate(self.fixture.staff)
+
+        response = self.client.get(self.url)
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response['ETag'])
+        self.assertTrue(response['Last-Modified'])
+
+    def test_conditional_request_does_not_run_optimization_if_plan_is_not_changed(self):
+        self.client.force_authenticate(self.fixture.staff)
+        etag = self.client.get(self.url)['ETag']
+
+        with mock.patch('waldur_cost_planning.optimizers.SingleServiceStrategy.get_optimized') as get_optimized:
+            response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertFalse(get_optimized.called)
+
+    def test_cached_result_is_returned_if_plan_is_not_changed(self):
+        self.client.force_authenticate(self.fixture.staff)
+        self.client.get(self.url)
+
+        with mock.patch('waldur_cost_planning.optimizers.SingleServiceStrategy.get_optimized') as get_optimized:
+            response = self.client.get(self.url)
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertFalse(get_optimized.called)
+
+    def test_etag_is_changed_when_plan_items_are_changed(self):
+        self.client.force_authenticate(self.fixture.staff)
+        etag = self.client.get(self.url)['ETag']
+
+        factories.DeploymentPlanItemFactory(plan=self.plan)
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_etag_is_changed_when_preset_is_renamed(self):
+        factories.DeploymentPlanItemFactory(plan=self.plan, preset=self.fixture.preset)
+        self.client.force_authenticate(self.fixture.staff)
+        etag = self.client.get(self.url)['ETag']
+
+        self.fixture.preset.name = 'Renamed preset'
+        self.fixture.preset.save()
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(response['ETag'], etag)
+
+
+@override_settings(WALDUR_COST_PLANNING=dict(settings.WALDUR_COST_PLANNING, evaluation_jobs_eager=True))
+@ddt
+class DeploymentPlanEvaluationJobTest(test.APITransactionTestCase):
+
+    def setUp(self):
+        self.fixture = fixtures.CostPlanningFixture()
+        self.plan = self.fixture.deployment_plan
+        self.url = factories.DeploymentPlanFactory.get_url(self.plan, action='evaluate')
+
+    def test_evaluation_job_result_matches_synchronous_evaluation(self):
+        self.client.force_authenticate(self.fixture.staff)
+
+        response = self.client.post(self.url)
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+
+        job_response = self.client.get(response.data['url'])
+        self.assertEqual(job_response.status_code, status.HTTP_200_OK)
+        self.assertEqual(job_response.data['state'], 'done')
+        self.assertEqual(job_response.data['result'], self.client.get(self.url).data)
+
+    @data('global_support', 'manager')
+    def test_user_who_can_see_plan_can_start_evaluation_job(self, user):
+        self.client.force_authenticate(getattr(self.fixture, user))
+
+        response = self.client.post(self.url)
+
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+
+    def test_user_without_permission_cannot_start_evaluation_job(self):
+        self.client.force_authenticate(self.fixture.user)
+
+        response = self.client.post(self.url)
+
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_user_without_permission_cannot_get_evaluation_job(self):
+        self.client.force_authenticate(self.fixture.staff)
+        job_url = self.client.post(self.url).data['url']
+
+        self.client.force_authenticate(self.fixture.user)
+        response = self.client.get(job_url)
+
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_unknown_evaluation_job_is_not_found(self):
+        self.client.force_authenticate(self.fixture.staff)
+
+        response = self.client.get('http://testserver/api/deployment-plan-evaluations/%s/' % ('0' * 32))
+
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+
+@ddt
+class DeploymentPlanImportTest(test.APITransactionTestCase):
+
+    def setUp(self):
+        self.fixture = fixtures.CostPlanningFixture()
+        self.preset1 = self.fixture.preset
+        self.preset2 = factories.PresetFactory(category=self.fixture.category, variant=models.Preset.LARGE)
+        self.project = self.fixture.project.uuid.hex
+
+    @data('owner', 'staff', 'admin', 'manager')
+    def test_user_with_permissions_can_import_plans_from_json_lines(self, user):
+        response = self.import_plans(getattr(self.fixture, user), self.get_json_lines(
+            {'name': 'plan1', 'project': self.project, 'items': [{'preset': self.preset1.uuid.hex, 'quantity': 2}]},
+            {'name': 'plan2', 'project': self.project, 'items': [
+                {'category': self.fixture.category.name, 'name': self.preset2.name, 'variant': 'Large'}]},
+        ))
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED, response.data)
+
+        plans = models.DeploymentPlan.objects.filter(uuid__in=[plan['uuid'] for plan in response.data])
+        self.assertEqual(plans.count(), 2)
+        self.assertEqual(plans.get(name='plan1').items.get().quantity, 2)
+        self.assertEqual(plans.get(name='plan2').items.get().preset, self.preset2)
+
+    @data('global_support')
+    def test_user_without_permissions_cannot_import_plans(self, user):
+        response = self.import_plans(getattr(self.fixture, user), self.get_json_lines(
+            {'name': 'plan1', 'project': self.project, 'items': []}))
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN, response.data)
+
+    def test_plans_are_imported_from_csv(self):
+        certification = structure_factories.ServiceCertificationFactory()
+        content = '\n'.join([
+            'plan,project,certifications,preset,category,name,variant,quantity',
+            'plan1,%s,%s,%s,,,,3' % (self.project, certification.uuid.hex, self.preset1.uuid.hex),
+            'plan1,%s,%s,,%s,%s,large,1' % (
+                self.project, certification.uuid.hex, self.fixture.category.name, self.preset2.name),
+            'plan2,%s,,,,,,' % self.project,
+        ])
+        response = self.import_plans(self.fixture.owner, content, content_type='text/csv')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED, response.data)
+
+        plan = models.DeploymentPlan.objects.get(uuid=response.data[0]['uuid'])
+        self.assertEqual(dict(plan.items.values_list('preset', 'quantity')), {
+            self.preset1.id: 3,
+            self.preset2.id: 1,
+        })
+        self.assertEqual(list(plan.certifications.all()), [certification])
+        self.assertFalse(models.DeploymentPlan.objects.get(uuid=response.data[1]['uuid']).items.exists())
+
+    def test_nothing_is_imported_if_any_plan_is_invalid(self):
+        response = self.import_plans(self.fixture.owner, self.get_json_lines(
+            {'name': 'plan1', 'project': self.project, 'items': [{'preset': self.preset1.uuid.hex}]},
+            {'name': 'plan2', 'project': self.project, 'items': [{'preset': 'invalid'}]},
+            {'name': 'plan3', 'project': 'invalid', 'items': []},
+        ))
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(len(response.data), 2)
+        self.assertTrue(response.data[0].startswith('Line 2:'))
+        self.assertTrue(response.data[1].startswith('Line 3:'))
+        self.assertFalse(models.DeploymentPlan.objects.filter(name__in=['plan1', 'plan2', 'plan3']).exists())
+
+    def test_queries_count_does_not_depend_on_plans_count(self):
+        with CaptureQueriesContext(connection) as initial_queries:
+            self.import_plans(self.fixture.owner, self.get_json_lines(*self.get_plans(2)))
+
+        with CaptureQueriesContext(connection) as final_queries:
+            self.import_plans(self.fixture.owner, self.get_json_lines(*self.get_plans(20)))
+
+        self.assertEqual(models.DeploymentPlan.objects.filter(project=self.fixture.project).count(), 22)
+        self.assertEqual(len(initial_queries), len(final_queries))
+
+    def get_plans(self, count):
+        return [{'name': 'plan%s' % index, 'project': self.project, 'items': [
+            {'preset': self.preset1.uuid.hex, 'quantity': index},
+            {'preset': self.preset2.uuid.hex},
+        ]} for index in range(count)]
+
+    def get_json_lines(self, *plans):
+        return '\n'.join(json.dumps(plan) for plan in plans)
+
+    def import_plans(self, user, content, content_type='application/x-ndjson'):
+        self.client.force_authenticate(user)
+        return self.client.generic('POST', factories.DeploymentPlanFactory.get_list_url('import'),
+                                   content, content_type=content_type)
+
+
+class DeploymentPlanExportTest(test.APITransactionTestCase):
+
+    def setUp(self):
+        self.fixture = fixtures.CostPlanningFixture()
+        self.plan = self.fixture.deployment_plan
+        factories.DeploymentPlanItemFactory(plan=self.plan, preset=self.fixture.preset, quantity=2)
+        self.plan.certifications.add(structure_factories.ServiceCertificationFactory())
+
+    def test_exported_plans_can_be_imported_again(self):
+        for file_format, content_type in (('jsonl', 'application/x-ndjson'), ('csv', 'text/csv')):
+            content = self.export_plans(file_format)
+
+            response = self.client.generic('POST', factories.DeploymentPlanFactory.get_list_url('import'),
+                                           content, content_type=content_type)
+            self.assertEqual(response.status_code, status.HTTP_201_CREATED, response.data)
+
+            plan = models.DeploymentPlan.objects.get(uuid=response.data[0]['uuid'])
+            self.assertEqual(plan.name, self.plan.name)
+            self.assertEqual(list(plan.items.values_list('preset', 'quantity')), [(self.fixture.preset.id, 2)])
+            self.assertEqual(set(plan.certifications.all()), set(self.plan.certifications.all()))
+            plan.delete()
+
+    def test_user_without_permissions_does_not_see_plans_in_export(self):
+        self.client.force_authenticate(self.fixture.user)
+        response = self.client.get(factories.DeploymentPlanFactory.get_list_url('export'))
+        self.assertEqual(b''.join(response.streaming_content), b'')
+
+    def test_exported_plans_are_filtered(self):
+        factories.DeploymentPlanFactory()
+        content = self.export_plans('jsonl', project_uuid=self.fixture.project.uuid.hex)
+        self.assertEqual(len(content.splitlines()), 1)
+
+    def export_plans(self, file_format, **params):
+        self.client.force_authenticate(self.fixture.staff)
+        params['file_format'] = file_format
+        response = self.client.get(factories.DeploymentPlanFactory.get_list_url('export'), params)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return b''.join(response.streaming_content).decode('utf-8')
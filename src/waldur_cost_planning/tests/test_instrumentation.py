@@ -0,0 +1,40 @@
+import threading
+
+import mock
+from django.db import connection
+from rest_framework import test
+
+from . import factories
+from .. import instrumentation, models
+
+
+class ProfilerTest(test.APITransactionTestCase):
+    def setUp(self):
+        self.plan = factories.DeploymentPlanFactory()
+        self.profiler = instrumentation.Profiler()
+
+    def test_queries_of_services_optimized_by_workers_are_added_to_total(self):
+        with self.profiler.measure_total(self.plan):
+            models.Category.objects.count()
+            worker = threading.Thread(target=self._optimize)
+            worker.start()
+            worker.join()
+
+        self.assertEqual(self.profiler.records[0]['queries'], 1)
+        self.assertEqual(self.profiler.total['queries'], 2)
+
+    def test_queries_of_services_optimized_by_current_thread_are_counted_once(self):
+        with self.profiler.measure_total(self.plan):
+            models.Category.objects.count()
+            with self.profiler.measure_service(mock.Mock()):
+                models.Category.objects.count()
+
+        self.assertEqual(self.profiler.records[0]['queries'], 1)
+        self.assertEqual(self.profiler.total['queries'], 2)
+
+    def _optimize(self):
+        try:
+            with self.profiler.measure_service(mock.Mock()):
+                models.Category.objects.count()
+        finally:
+            connection.close()
@@ -1,13 +1,21 @@
+import json
+
+import mock
 from ddt import ddt, data
 from django.contrib.contenttypes.models import ContentType
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 from rest_framework import status, test
 
 from waldur_core.cost_tracking import models as ct_models
 from waldur_core.cost_tracking.tests import factories as ct_factories
+from waldur_core.quotas import models as quotas_models
 from waldur_openstack.openstack_tenant import models as ot_models, cost_tracking as ot_cost_tracking
 from waldur_openstack.openstack_tenant.tests import factories as ot_factories
 
 from . import factories, fixtures
+from .. import catalogs, evaluations, optimizers, serializers
+from ..plugins import openstack_tenant
 
 
 @ddt
@@ -61,6 +69,168 @@ class OpenStackTenantOptimizerTest(test.APITransactionTestCase):
         self.assertTrue(data[0]['error_message'])
         self.assertTrue('It is too big' in data[0]['error_message'])
 
+    def test_optimization_metrics_are_reported_to_staff_if_requested(self):
+        self.preset = factories.PresetFactory(category=self.fixture.category, cores=1, ram=1024)
+        factories.DeploymentPlanItemFactory(plan=self.plan, preset=self.preset)
+        self.client.force_authenticate(self.fixture.staff)
+
+        response = self.client.get(self.url, {'profile': 1})
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        server_timing = response['Server-Timing']
+        self.assertIn('total;dur=', server_timing)
+        self.assertIn('service-0;dur=', server_timing)
+        self.assertIn('catalog size 4, items 1', server_timing)
+
+    def test_optimization_metrics_are_not_reported_by_default(self):
+        response = self._get_response({'variant': 'small', 'cores': 1, 'ram': 1024})
+
+        self.assertFalse(response.has_header('Server-Timing'))
+
+    def test_streamed_evaluation_result_matches_regular_result(self):
+        self.preset = factories.PresetFactory(category=self.fixture.category, cores=1, ram=1024)
+        factories.DeploymentPlanItemFactory(plan=self.plan, preset=self.preset)
+        self.client.force_authenticate(self.fixture.staff)
+
+        streamed = self.client.get(self.url, {'stream': 1})
+        self.assertEqual(streamed['Content-Type'], 'application/x-ndjson')
+        lines = b''.join(streamed.streaming_content).decode('utf-8').splitlines()
+
+        response = self.client.get(self.url)
+        self.assertEqual([json.loads(line) for line in lines], response.json())
+        self.assertEqual(streamed['ETag'], response['ETag'])
+
+    def test_streamed_evaluation_result_is_cached(self):
+        self.preset = factories.PresetFactory(category=self.fixture.category, cores=1, ram=1024)
+        factories.DeploymentPlanItemFactory(plan=self.plan, preset=self.preset)
+        self.client.force_authenticate(self.fixture.staff)
+        b''.join(self.client.get(self.url, {'stream': 1}).streaming_content)
+
+        with mock.patch.object(optimizers.SingleServiceStrategy, 'iter_optimized') as iter_optimized:
+            response = self.client.get(self.url, {'stream': 1})
+            lines = b''.join(response.streaming_content).splitlines()
+
+        self.assertFalse(iter_optimized.called)
+        self.assertEqual(len(lines), 1)
+        self.assertTrue(response.has_header('Last-Modified'))
+
+    def test_services_more_expensive_than_max_price_are_not_returned(self):
+        self.preset = factories.PresetFactory(category=self.fixture.category, cores=1, ram=1024)
+        factories.DeploymentPlanItemFactory(plan=self.plan, preset=self.preset)
+        ct_models.DefaultPriceListItem.objects.update(value=1)
+        catalogs.bump_version()
+        self.client.force_authenticate(self.fixture.staff)
+        price = self.client.get(self.url).json()[0]['price']
+
+        self.assertEqual(len(self.client.get(self.url, {'max_price': price, 'limit': 1}).json()), 1)
+        self.assertEqual(self.client.get(self.url, {'max_price': '0.0000000001'}).json(), [])
+
+    def test_plan_is_spread_across_services_if_split_strategy_is_requested(self):
+        for cores in (1, 2):
+            preset = factories.PresetFactory(category=self.fixture.category, cores=cores, ram=1024)
+            factories.DeploymentPlanItemFactory(plan=self.plan, preset=preset)
+        self.client.force_authenticate(self.fixture.staff)
+
+        response = self.client.get(self.url, {'strategy': 'split'})
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK, response.data)
+        self.assertEqual(len(response.data), 1)
+        self.assertEqual(len(response.data[0]['optimized_presets']), 2)
+        self.assertEqual(response.data[0]['price'], self.client.get(self.url).data[0]['price'])
+
+    def test_split_strategy_reports_preset_that_does_not_fit_any_service(self):
+        preset = factories.PresetFactory(category=self.fixture.category, cores=64, ram=1024)
+        factories.DeploymentPlanItemFactory(plan=self.plan, preset=preset)
+        self.client.force_authenticate(self.fixture.staff)
+
+        response = self.client.get(self.url, {'strategy': 'split'})
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn(preset.name, response.data['detail'])
+
+    def test_limit_is_not_supported_by_split_strategy(self):
+        self.client.force_authenticate(self.fixture.staff)
+        response = self.client.get(self.url, {'strategy': 'split', 'limit': 1})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_flavors_that_fit_remaining_quotas_are_chosen_if_capacity_is_requested(self):
+        self._set_flavor_prices({'flavor-1': 5, 'flavor-2': 2, 'flavor-3': 3, 'flavor-4': 1})
+        self._set_quota('vcpu', limit=6, usage=2)
+        self.preset = factories.PresetFactory(category=self.fixture.category, cores=1, ram=1024)
+        factories.DeploymentPlanItemFactory(plan=self.plan, preset=self.preset, quantity=2)
+        self.client.force_authenticate(self.fixture.staff)
+
+        self.assertEqual(self.client.get(self.url).data[0]['optimized_presets'][0]['flavor']['name'], 'flavor-4')
+
+        response = self.client.get(self.url, {'capacity': 'true'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertFalse(response.data[0]['error_message'])
+        self.assertEqual(response.data[0]['optimized_presets'][0]['flavor']['name'], 'flavor-2')
+
+    def test_error_is_reported_if_plan_does_not_fit_remaining_quotas(self):
+        self._set_quota('vcpu', limit=10, usage=9)
+        self.preset = factories.PresetFactory(category=self.fixture.category, cores=1, ram=1024)
+        factories.DeploymentPlanItemFactory(plan=self.plan, preset=self.preset, quantity=2)
+        self.client.force_authenticate(self.fixture.staff)
+
+        response = self.client.get(self.url, {'capacity': 'true'})
+
+        self.assertIn('Remaining quotas of tenant are not enough', response.data[0]['error_message'])
+
+    def test_unlimited_quotas_are_ignored(self):
+        self._set_quota('vcpu', limit=-1, usage=100)
+        self.preset = factories.PresetFactory(category=self.fixture.category, cores=1, ram=1024)
+        factories.DeploymentPlanItemFactory(plan=self.plan, preset=self.preset, quantity=2)
+        self.client.force_authenticate(self.fixture.staff)
+
+        response = self.client.get(self.url, {'capacity': 'true'})
+
+        self.assertFalse(response.data[0]['error_message'])
+
+    def test_limit_should_be_positive(self):
+        self.client.force_authenticate(self.fixture.staff)
+        response = self.client.get(self.url, {'limit': 0})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_batch_evaluation_result_matches_evaluation_of_each_plan(self):
+        plans = [self.plan, factories.DeploymentPlanFactory(project=self.fixture.project)]
+        for plan, cores in zip(plans, (1, 2)):
+            preset = factories.PresetFactory(category=self.fixture.category, cores=cores, ram=1024)
+            factories.DeploymentPlanItemFactory(plan=plan, preset=preset)
+        self.client.force_authenticate(self.fixture.staff)
+
+        response = self.client.post(factories.DeploymentPlanFactory.get_list_url('evaluate'),
+                                    {'plans': [plan.uuid.hex for plan in plans]})
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK, response.data)
+        results = {result['uuid']: result['services'] for result in response.json()}
+        for plan in plans:
+            expected = self.client.get(factories.DeploymentPlanFactory.get_url(plan, action='evaluate')).json()
+            self.assertEqual(results[plan.uuid.hex], expected)
+
+    def test_preset_and_flavor_are_rendered_once_for_all_services(self):
+        preset = factories.PresetFactory(category=self.fixture.category, cores=1, ram=1024)
+        factories.DeploymentPlanItemFactory(plan=self.plan, preset=preset)
+        optimized_service = openstack_tenant.OpenStackTenantOptimizer().optimize(self.plan, self.service)
+
+        data = serializers.OptimizedServiceSummarySerializer(
+            [optimized_service, optimized_service], many=True,
+            context={'request': evaluations.BaseURLRequest('http://testserver/')}).data
+
+        first, second = [service['optimized_presets'][0] for service in data]
+        self.assertIs(first['preset'], second['preset'])
+        self.assertIs(first['flavor'], second['flavor'])
+
+    def _set_flavor_prices(self, prices):
+        for name, price in prices.items():
+            ct_models.DefaultPriceListItem.objects.filter(key=name).update(value=price)
+        catalogs.bump_version()
+
+    def _set_quota(self, name, limit, usage):
+        quotas_models.Quota.objects.update_or_create(
+            content_type=ContentType.objects.get_for_model(self.settings), object_id=self.settings.id, name=name,
+            defaults={'limit': limit, 'usage': usage})
+
     def _get_response(self, preset_param):
         self.preset = factories.PresetFactory(category=self.fixture.category, **preset_param)
         factories.DeploymentPlanItemFactory(plan=self.plan, preset=self.preset)
@@ -68,3 +238,166 @@ class OpenStackTenantOptimizerTest(test.APITransactionTestCase):
         self.client.force_authenticate(self.fixture.staff)
         response = self.client.get(self.url)
         return response
+
+
+class OpenStackTenantOptimizerQueriesTest(test.APITransactionTestCase):
+    def setUp(self):
+        self.fixture = fixtures.CostPlanningOpenStackPluginFixture()
+        self.plan = self.fixture.deployment_plan
+        self.service = self.fixture.spl.service
+        self.flavors_count = 0
+
+        ct_factories.DefaultPriceListItemFactory(
+            resource_content_type=ContentType.objects.get_for_model(ot_models.Volume),
+            item_type=ot_cost_tracking.VolumeStrategy.Types.STORAGE,
+            key=ot_cost_tracking.VolumeStrategy.Keys.STORAGE,
+        )
+        self._create_flavors(2)
+        self._create_items(2)
+
+    def test_queries_count_does_not_depend_on_flavors_and_items_count(self):
+        # Warm up content types cache
+        self._optimize()
+        catalogs.bump_version()
+        with CaptureQueriesContext(connection) as initial_queries:
+            self._optimize()
+
+        self._create_flavors(20)
+        self._create_items(10)
+
+        catalogs.bump_version()
+        with CaptureQueriesContext(connection) as final_queries:
+            optimized_service = self._optimize()
+
+        self.assertEqual(len(optimized_service.optimized_presets), 12)
+        self.assertEqual(len(initial_queries), len(final_queries))
+
+    def test_strategy_queries_count_does_not_depend_on_services_and_items_count(self):
+        ot_factories.OpenStackTenantServiceProjectLinkFactory(project=self.fixture.project)
+        # Catalogs of all services are built before each measurement, they are cached until catalogs are changed
+        optimizers.SingleServiceStrategy(self.plan).get_optimized()
+        with CaptureQueriesContext(connection) as initial_queries:
+            optimized_services = optimizers.SingleServiceStrategy(self.plan).get_optimized()
+        self.assertEqual(len(optimized_services), 2)
+
+        for _ in range(3):
+            ot_factories.OpenStackTenantServiceProjectLinkFactory(project=self.fixture.project)
+        self._create_items(10)
+
+        optimizers.SingleServiceStrategy(self.plan).get_optimized()
+        with CaptureQueriesContext(connection) as final_queries:
+            optimized_services = optimizers.SingleServiceStrategy(self.plan).get_optimized()
+        self.assertEqual(len(optimized_services), 5)
+
+        self.assertEqual(len(initial_queries), len(final_queries))
+
+    def test_catalog_is_loaded_once_for_all_plans(self):
+        plans = [self.plan] + [factories.DeploymentPlanFactory(project=self.fixture.project) for _ in range(3)]
+        for plan in plans[1:]:
+            factories.DeploymentPlanItemFactory(plan=plan, preset=self.plan.items.first().preset)
+        get_catalog = openstack_tenant.OpenStackTenantOptimizer.get_catalog
+
+        with mock.patch.object(openstack_tenant.OpenStackTenantOptimizer, 'get_catalog',
+                               autospec=True, side_effect=get_catalog) as load:
+            results = evaluations.evaluate_plans(plans, 'http://testserver/', render=list)
+
+        self.assertEqual(load.call_count, 1)
+        self.assertEqual([len(data) for _, data in results], [1, 1, 1, 1])
+
+    def test_batch_evaluation_queries_count_does_not_depend_on_plans_count(self):
+        url = factories.DeploymentPlanFactory.get_list_url('evaluate')
+        self.client.force_authenticate(self.fixture.staff)
+        self.client.get(url)
+
+        catalogs.bump_version()
+        with CaptureQueriesContext(connection) as initial_queries:
+            response = self.client.get(url)
+        self.assertEqual(len(response.data), 1)
+
+        for _ in range(5):
+            plan = factories.DeploymentPlanFactory(project=self.fixture.project)
+            factories.DeploymentPlanItemFactory(plan=plan, preset=self.plan.items.first().preset)
+
+        catalogs.bump_version()
+        with CaptureQueriesContext(connection) as final_queries:
+            response = self.client.get(url)
+        self.assertEqual(len(response.data), 6)
+
+        self.assertEqual(len(initial_queries), len(final_queries))
+
+    def test_cheapest_flavor_is_looked_up_once_for_equal_requirements(self):
+        self._create_items(5)
+        optimizer = openstack_tenant.OpenStackTenantOptimizer()
+
+        with mock.patch.object(optimizer, 'get_cheapest_choice', wraps=optimizer.get_cheapest_choice) as lookup:
+            optimized_service = optimizer.optimize(self.plan, self.service)
+
+        self.assertEqual(lookup.call_count, 1)
+        self.assertEqual(len(optimized_service.optimized_presets), 7)
+
+    def test_only_new_requirements_are_looked_up_when_plan_is_evaluated_again(self):
+        self._evaluate()
+        preset = factories.PresetFactory(category=self.fixture.category, cores=2, ram=2048)
+        factories.DeploymentPlanItemFactory(plan=self.plan, preset=preset)
+
+        with self._count_lookups() as lookup:
+            data, _ = self._evaluate()
+
+        self.assertEqual(lookup.call_count, 1)
+        self.assertEqual(len(data[0].optimized_presets), 3)
+
+    def test_choices_are_not_looked_up_when_only_quantity_is_changed(self):
+        self._evaluate()
+        self.plan.items.update(quantity=5)
+
+        with self._count_lookups() as lookup:
+            data, _ = self._evaluate()
+
+        self.assertEqual(lookup.call_count, 0)
+        self.assertEqual([preset.quantity for preset in data[0].optimized_presets], [5, 5])
+
+    def test_only_identifiers_and_prices_of_choices_are_stored(self):
+        self._evaluate()
+
+        partials = optimizers.PartialResults(self.plan.uuid.hex)
+        stored = [choice for choices in partials.choices.values() for choice in choices.values()]
+        self.assertTrue(stored)
+        for flavor_pk, flavor_price, storage_price in stored:
+            self.assertTrue(ot_models.Flavor.objects.filter(pk=flavor_pk).exists())
+
+    def test_all_choices_are_looked_up_again_when_catalogs_are_changed(self):
+        self._evaluate()
+        factories.DeploymentPlanItemFactory(
+            plan=self.plan, preset=factories.PresetFactory(category=self.fixture.category, cores=2, ram=2048))
+        catalogs.bump_version()
+
+        with self._count_lookups() as lookup:
+            self._evaluate()
+
+        self.assertEqual(lookup.call_count, 2)
+
+    def _evaluate(self):
+        return evaluations.Evaluation(self.plan, 'http://testserver/').evaluate(render=list)
+
+    def _count_lookups(self):
+        get_cheapest_choice = openstack_tenant.OpenStackTenantOptimizer.get_cheapest_choice
+        return mock.patch.object(openstack_tenant.OpenStackTenantOptimizer, 'get_cheapest_choice',
+                                 autospec=True, side_effect=get_cheapest_choice)
+
+    def _optimize(self):
+        return openstack_tenant.OpenStackTenantOptimizer().optimize(self.plan, self.service)
+
+    def _create_flavors(self, count):
+        for _ in range(count):
+            self.flavors_count += 1
+            flavor = ot_factories.FlavorFactory(
+                settings=self.service.settings, cores=self.flavors_count, ram=self.flavors_count * 1024)
+            ct_models.DefaultPriceListItem.objects.update_or_create(
+                resource_content_type=ContentType.objects.get_for_model(ot_models.Instance),
+                item_type=ot_cost_tracking.InstanceStrategy.Types.FLAVOR,
+                key=flavor.name)
+
+    def _create_items(self, count):
+        for _ in range(count):
+            preset = factories.PresetFactory(category=self.fixture.category, cores=1, ram=1024)
+            factories.DeploymentPlanItemFactory(plan=self.plan, preset=preset)
@@ -0,0 +1,346 @@
+import collections
+import itertools
+import pickle
+import random
+import unittest
+
+import mock
+from django.test import override_settings
+from rest_framework import test
+
+from waldur_core.structure.tests import factories as structure_factories
+
+from . import factories, fixtures
+from .. import models, optimizers
+
+
+Size = collections.namedtuple('Size', ('name', 'cores', 'ram', 'disk', 'price'))
+
+
+class SizeCatalogIndexTest(unittest.TestCase):
+    index_class = optimizers.SizeCatalogIndex
+
+    def setUp(self):
+        self.sizes = [
+            Size('small', cores=1, ram=1024, disk=10, price=5),
+            Size('medium', cores=2, ram=2048, disk=20, price=10),
+            Size('large', cores=4, ram=8192, disk=40, price=20),
+            Size('expensive-medium', cores=2, ram=2048, disk=20, price=15),
+            Size('big-disk', cores=1, ram=1024, disk=100, price=12),
+        ]
+
+    def get_index(self, sizes=None):
+        return self.index_class(sizes or self.sizes, get_price=lambda size: size.price)
+
+    def test_cheapest_suitable_size_is_returned(self):
+        index = self.get_index()
+        self.assertEqual(index.get_cheapest(2, 1024, 10), (self.sizes[1], 10))
+        self.assertEqual(index.get_cheapest(1, 1024, 50), (self.sizes[4], 12))
+        self.assertEqual(index.get_cheapest(3, 0, 0), (self.sizes[2], 20))
+
+    def test_none_is_returned_if_preset_is_too_big(self):
+        self.assertIsNone(self.get_index().get_cheapest(8, 0, 0))
+        self.assertIsNone(self.get_index().get_cheapest(1, 1024, 1000))
+
+    def test_sizes_with_the_same_resources_as_cheaper_size_are_dropped(self):
+        self.assertEqual(len(self.get_index()), 4)
+
+    def test_sizes_that_do_not_offer_more_than_cheaper_size_are_dropped(self):
+        sizes = self.sizes + [Size('dominated', cores=1, ram=2048, disk=20, price=11)]
+        index = self.get_index(sizes)
+        self.assertEqual(len(index), 4)
+        self.assertEqual(index.get_cheapest(1, 2048, 20), (self.sizes[1], 10))
+
+    def test_first_size_wins_if_prices_are_equal(self):
+        sizes = [
+            Size('first', cores=2, ram=2048, disk=20, price=10),
+            Size('second', cores=4, ram=4096, disk=40, price=10),
+        ]
+        index = self.get_index(sizes)
+        self.assertEqual(index.get_cheapest(1, 0, 0)[0].name, 'first')
+        self.assertEqual(index.get_cheapest(3, 0, 0)[0].name, 'second')
+
+    def test_index_can_be_built_for_subset_of_attributes(self):
+        index = self.index_class(self.sizes, get_price=lambda size: size.price, attributes=('cores', 'ram'))
+        self.assertEqual(index.get_cheapest(1, 1024), (self.sizes[0], 5))
+
+    def test_index_result_matches_linear_search(self):
+        generator = random.Random(0)
+        sizes = [Size('size-%s' % i, generator.randint(1, 32), generator.randint(1, 64) * 1024,
+                      generator.randint(1, 100) * 10, generator.randint(1, 1000))
+                 for i in range(300)]
+        index = self.get_index(sizes)
+        for _ in range(200):
+            requirements = (generator.randint(1, 32), generator.randint(1, 64) * 1024, generator.randint(1, 100) * 10)
+            suitable = [size for size in sizes if
+                        size.cores >= requirements[0] and size.ram >= requirements[1] and size.disk >= requirements[2]]
+            result = index.get_cheapest(*requirements)
+            if not suitable:
+                self.assertIsNone(result)
+            else:
+                self.assertEqual(result[0], min(suitable, key=lambda size: size.price))
+
+    def test_many_requirements_are_solved_at_once(self):
+        index = self.get_index()
+        self.assertEqual(index.get_cheapest_many([(2, 1024, 10), (8, 0, 0), (2, 1024, 10)]),
+                         [(self.sizes[1], 10), None, (self.sizes[1], 10)])
+
+    def test_empty_catalog_has_no_suitable_sizes(self):
+        index = self.index_class([], get_price=lambda size: size.price)
+        self.assertEqual(index.get_cheapest_many([(1, 1, 1)]), [None])
+        self.assertIsNone(index.min_price)
+
+    def test_min_price_is_price_of_the_cheapest_size(self):
+        self.assertEqual(self.get_index().min_price, 5)
+
+
+@unittest.skipIf(optimizers.numpy is None, 'NumPy is not installed.')
+class VectorizedSizeCatalogIndexTest(SizeCatalogIndexTest):
+    index_class = optimizers.VectorizedSizeCatalogIndex
+
+
+class OptimizedServiceTest(unittest.TestCase):
+    def setUp(self):
+        self.service = mock.Mock(pk=1)
+        self.service._meta.label = 'openstack_tenant.OpenStackTenantService'
+        self.service.uuid.hex = 'service-uuid'
+        self.service.settings.uuid.hex = 'settings-uuid'
+        self.service.settings.name = 'Tenant'
+        self.service.settings.type = 'OpenStackTenant'
+
+    def test_only_identifiers_and_names_of_service_are_stored(self):
+        optimized_service = optimizers.OptimizedService(service=self.service, price=10)
+
+        self.assertEqual(optimized_service.__getstate__(), (
+            'openstack_tenant.OpenStackTenantService', 1, 'service-uuid',
+            'settings-uuid', 'Tenant', 'OpenStackTenant', 10, ''))
+
+    def test_record_survives_pickling(self):
+        optimized_service = optimizers.OptimizedService(service=self.service, price=10)
+
+        self.assertEqual(pickle.loads(pickle.dumps(optimized_service, pickle.HIGHEST_PROTOCOL)), optimized_service)
+
+    def test_unknown_field_is_not_accepted(self):
+        with self.assertRaises(TypeError):
+            optimizers.OptimizedService(price=10, service_name='Tenant')
+
+
+class SingleServiceStrategyTest(unittest.TestCase):
+    def setUp(self):
+        self.services = [mock.Mock(name='service-%s' % i) for i in range(10)]
+        self.strategy = optimizers.SingleServiceStrategy(mock.Mock(), services=self.services)
+
+    def optimize(self, service):
+        if service is self.services[3]:
+            return None
+        return optimizers.OptimizedService(service=service, price=self.services.index(service))
+
+    @override_settings(WALDUR_COST_PLANNING={'optimization_workers': 4})
+    def test_services_are_optimized_concurrently_in_deterministic_order(self):
+        with mock.patch.object(self.strategy, '_get_optimized_service', side_effect=self.optimize):
+            optimized = self.strategy.get_optimized()
+
+        expected = [service for service in self.services if service is not self.services[3]]
+        self.assertEqual([optimized_service.service_uuid for optimized_service in optimized],
+                         [service.uuid.hex for service in expected])
+
+    @override_settings(WALDUR_COST_PLANNING={'optimization_workers': 1})
+    def test_services_are_optimized_sequentially_by_default(self):
+        with mock.patch.object(self.strategy, '_get_optimized_service', side_effect=self.optimize):
+            optimized = self.strategy.get_optimized()
+
+        self.assertEqual(len(optimized), 9)
+
+    @override_settings(WALDUR_COST_PLANNING={'optimization_workers': 1})
+    def test_services_are_yielded_as_soon_as_they_are_optimized(self):
+        with mock.patch.object(self.strategy, '_get_optimized_service', side_effect=self.optimize) as optimize:
+            optimized = self.strategy.iter_optimized()
+            optimized_service = next(optimized)
+
+        self.assertEqual(optimized_service.service_uuid, self.services[0].uuid.hex)
+        self.assertEqual(optimize.call_count, 1)
+
+
+class CheapestServicesStrategyTest(unittest.TestCase):
+    def setUp(self):
+        self.services = [mock.Mock(name='service-%s' % i) for i in range(5)]
+        self.bounds = dict(zip(self.services, [10, 1, 5, 20, 3]))
+        self.prices = {service: bound + 1 for service, bound in self.bounds.items()}
+
+    def get_optimized(self, **kwargs):
+        strategy = optimizers.CheapestServicesStrategy(mock.Mock(), services=self.services, **kwargs)
+        with mock.patch.object(strategy, '_get_lower_bound', side_effect=self.bounds.get), \
+                mock.patch.object(strategy, '_get_optimized_service', side_effect=self.optimize) as optimize:
+            optimized = strategy.get_optimized()
+        return optimized, optimize.call_count, strategy.skipped
+
+    def optimize(self, service):
+        if service is self.services[1]:
+            return optimizers.OptimizedService(service=service, price=None, error_message='Too big.')
+        return optimizers.OptimizedService(service=service, price=self.prices[service])
+
+    def test_services_that_can_not_beat_top_are_skipped(self):
+        optimized, optimized_count, skipped = self.get_optimized(limit=2)
+
+        self.assertEqual([service.price for service in optimized], [4, 6])
+        self.assertEqual(optimized_count, 3)
+        self.assertEqual(skipped, 2)
+
+    def test_services_more_expensive_than_max_price_are_skipped(self):
+        optimized, optimized_count, skipped = self.get_optimized(max_price=5)
+
+        self.assertEqual([service.price for service in optimized], [4])
+        self.assertEqual(optimized_count, 3)
+        self.assertEqual(skipped, 2)
+
+    def test_services_without_lower_bound_are_always_optimized(self):
+        self.bounds[self.services[3]] = None
+        optimized, _, _ = self.get_optimized(limit=1)
+
+        self.assertEqual(optimized[0].service_uuid, self.services[4].uuid.hex)
+
+
+class SplitStrategyTest(unittest.TestCase):
+    def setUp(self):
+        self.presets = [mock.Mock(cores=cores, ram=1024, storage=10) for cores in range(1, 4)]
+        for index, preset in enumerate(self.presets):
+            preset.name = 'preset-%s' % index
+        plan = mock.Mock(items=[models.PlanItem(preset=preset, quantity=2) for preset in self.presets])
+        plan.get_snapshot.return_value = plan
+        self.services = [mock.Mock(), mock.Mock()]
+        self.unit_prices = {
+            self.services[0]: {
+                (1, 1024, 10): ('size-a', 1),
+                (2, 1024, 10): ('size-b', 5),
+            },
+            self.services[1]: {
+                (1, 1024, 10): ('size-c', 3),
+                (2, 1024, 10): ('size-d', 2),
+                (3, 1024, 10): ('size-e', 4),
+            },
+        }
+        self.strategy = optimizers.SplitStrategy(plan, services=self.services)
+
+    def get_optimizer_class(self, service_type):
+        unit_prices = self.unit_prices
+        optimized_preset_class = collections.namedtuple('OptimizedPreset', ('preset', 'size', 'price'))
+
+        class Optimizer(object):
+            optimized_service_class = collections.namedtuple('Optimized', ('service', 'price', 'optimized_presets'))
+
+            def __init__(self, catalogs=None, quotas=None, choices=None):
+                pass
+
+            def get_unit_prices(self, service, presets):
+                # Choice contains both size and its price
+                return {requirements: ((size, price), price)
+                        for requirements, (size, price) in unit_prices[service].items()}
+
+            def get_optimized_preset(self, item, choice):
+                size, price = choice
+                return optimized_preset_class(preset=item.preset, size=size, price=price * item.quantity)
+
+        return Optimizer
+
+    def get_optimized(self):
+        with mock.patch.object(optimizers.register.Register, 'get_optimizer', side_effect=self.get_optimizer_class):
+            return self.strategy.get_optimized()
+
+    def test_each_item_is_assigned_to_the_cheapest_service(self):
+        optimized = self.get_optimized()
+
+        self.assertEqual([optimized_service.service for optimized_service in optimized], self.services)
+        self.assertEqual([[preset.size for preset in optimized_service.optimized_presets]
+                          for optimized_service in optimized], [['size-a'], ['size-d', 'size-e']])
+        self.assertEqual(sum(optimized_service.price for optimized_service in optimized), 14)
+
+    def test_error_is_raised_if_preset_could_not_be_deployed_on_any_service(self):
+        del self.unit_prices[self.services[1]][(3, 1024, 10)]
+
+        with self.assertRaises(optimizers.OptimizationError):
+            self.get_optimized()
+
+
+class CapacityPackerTest(unittest.TestCase):
+    def setUp(self):
+        # Candidates are (<unit price>, (<cores>, <ram>), <choice>)
+        self.items = [
+            (2, [(1, (4, 4096), 'large'), (2, (2, 2048), 'medium'), (5, (1, 1024), 'small')]),
+            (1, [(3, (8, 8192), 'xlarge'), (4, (4, 4096), 'large')]),
+        ]
+
+    def test_the_cheapest_candidates_are_chosen_if_capacity_is_unlimited(self):
+        packer = optimizers.CapacityPacker(self.items, (None, None), time_budget=1)
+        self.assertEqual(packer.solve(), ['large', 'xlarge'])
+
+    def test_the_cheapest_combination_that_fits_capacity_is_chosen(self):
+        packer = optimizers.CapacityPacker(self.items, (8, None), time_budget=1)
+        self.assertEqual(packer.solve(), ['medium', 'large'])
+
+    def test_result_matches_exhaustive_search(self):
+        generator = random.Random(0)
+        for _ in range(50):
+            items = [(generator.randint(1, 3), [
+                (generator.randint(1, 20), (generator.randint(1, 8), generator.randint(1, 8)), (index, choice))
+                for choice in range(generator.randint(1, 4))
+            ]) for index in range(generator.randint(1, 4))]
+            capacity = (generator.randint(4, 40), generator.randint(4, 40))
+
+            prices = []
+            for combination in itertools.product(*[candidates for _, candidates in items]):
+                resources = [sum(quantity * candidate[1][dimension] for (quantity, _), candidate
+                                 in zip(items, combination)) for dimension in range(2)]
+                if all(used <= amount for used, amount in zip(resources, capacity)):
+                    prices.append(sum(quantity * candidate[0] for (quantity, _), candidate in zip(items, combination)))
+
+            choices = optimizers.CapacityPacker(items, capacity, time_budget=1).solve()
+            if not prices:
+                self.assertIsNone(choices)
+            else:
+                candidates = [dict((choice, price) for price, _, choice in candidates) for _, candidates in items]
+                price = sum(quantity * candidates[index][choice]
+                            for index, ((quantity, _), choice) in enumerate(zip(items, choices)))
+                self.assertEqual(price, min(prices))
+
+    def test_shortage_is_reported_if_capacity_is_not_enough(self):
+        packer = optimizers.CapacityPacker(self.items, (5, 100000), time_budget=1)
+
+        self.assertIsNone(packer.solve())
+        self.assertEqual(packer.get_shortage(), [(0, 6, 5)])
+
+    def test_greedy_solution_is_returned_if_time_budget_is_exceeded(self):
+        packer = optimizers.CapacityPacker(self.items, (8, None), time_budget=-1)
+        packer.CLOCK_CHECK_INTERVAL = 1
+
+        self.assertIsNotNone(packer.solve())
+        self.assertTrue(packer.timed_out)
+
+
+class FilteredServicesTest(test.APITransactionTestCase):
+    def setUp(self):
+        self.fixture = fixtures.CostPlanningOpenStackPluginFixture()
+        self.plan = self.fixture.deployment_plan
+        self.service = self.fixture.spl.service
+        self.certification = structure_factories.ServiceCertificationFactory()
+        self.plan.certifications.add(self.certification)
+
+    def test_service_without_required_certification_is_skipped(self):
+        self.assertEqual(list(optimizers.get_filtered_services(self.plan)), [])
+
+    def test_service_with_all_required_certifications_is_returned(self):
+        self.service.settings.certifications.add(self.certification)
+
+        self.assertEqual(list(optimizers.get_filtered_services(self.plan)), [self.service])
+
+    def test_service_with_some_of_required_certifications_is_skipped(self):
+        self.service.settings.certifications.add(self.certification)
+        self.fixture.project.certifications.add(structure_factories.ServiceCertificationFactory())
+
+        self.assertEqual(list(optimizers.get_filtered_services(self.plan)), [])
+
+    def test_service_of_another_project_is_skipped(self):
+        self.service.settings.certifications.add(self.certification)
+        plan = factories.DeploymentPlanFactory()
+        plan.certifications.add(self.certification)
+
+        self.assertEqual(list(optimizers.get_filtered_services(plan)), [])
@@ -0,0 +1,311 @@
+""" Bulk import and export of deployment plans.
+
+Plans are transferred either as JSON lines, one plan per line:
+
+    {"name": "Webapp", "project": "<uuid>", "certifications": ["<uuid>"],
+     "items": [{"preset": "<uuid>", "quantity": 2},
+               {"category": "Databases", "name": "MySQL", "variant": "large", "quantity": 1}]}
+
+or as CSV with header and one plan item per row. Consecutive rows with
+the same plan name and project belong to the same plan:
+
+    plan,project,certifications,preset,category,name,variant,quantity
+
+Preset is referenced either by UUID or by category, name and variant.
+Certifications are optional and separated by spaces in CSV.
+"""
+from __future__ import unicode_literals
+
+import csv
+import json
+from uuid import UUID
+
+from django.db import transaction
+from django.utils import six
+from django.utils.encoding import force_bytes, force_text
+from rest_framework import exceptions
+
+from waldur_core.structure import models as structure_models, permissions as structure_permissions
+from waldur_core.structure.managers import filter_queryset_for_user
+
+from . import models
+
+
+JSON_LINES = 'jsonl'
+CSV = 'csv'
+FORMATS = (JSON_LINES, CSV)
+CONTENT_TYPES = {
+    JSON_LINES: 'application/x-ndjson',
+    CSV: 'text/csv',
+}
+
+CSV_FIELDS = ('plan', 'project', 'certifications', 'preset', 'category', 'name', 'variant', 'quantity')
+EXPORT_CHUNK_SIZE = 500
+MAX_QUANTITY = 32767
+
+
+def get_format(content_type):
+    content_type = (content_type or '').split(';')[0].strip().lower()
+    return CSV if content_type in ('text/csv', 'application/csv') else JSON_LINES
+
+
+def parse_plans(content, file_format):
+    """ Return list of (line number, plan data) pairs parsed from JSON lines or CSV """
+    content = force_text(content)
+    if file_format == CSV:
+        return _parse_csv(content)
+    return _parse_json_lines(content)
+
+
+def _parse_json_lines(content):
+    records = []
+    for line_number, line in enumerate(content.splitlines(), 1):
+        if not line.strip():
+            continue
+        try:
+            data = json.loads(line)
+        except ValueError:
+            raise exceptions.ValidationError('Line %s: invalid JSON.' % line_number)
+        if not isinstance(data, dict):
+            raise exceptions.ValidationError('Line %s: plan should be JSON object.' % line_number)
+        records.append((line_number, data))
+    return records
+
+
+def _parse_csv(content):
+    if six.PY2:
+        reader = csv.DictReader(six.BytesIO(force_bytes(content)))
+    else:
+        reader = csv.DictReader(six.StringIO(content))
+
+    records = []
+    for row in reader:
+        row = {force_text(key): force_text(value or '').strip() for key, value in row.items() if key}
+        key = (row.get('plan', ''), row.get('project', ''))
+        if not records or records[-1][2] != key:
+            data = {
+                'name': key[0],
+                'project': key[1],
+                'certifications': row.get('certifications', '').split(),
+                'items': [],
+            }
+            records.append((reader.line_num, data, key))
+        if any(row.get(field) for field in ('preset', 'category', 'name', 'variant')):
+            item = {field: row.get(field, '') for field in ('preset', 'category', 'name', 'variant')}
+            item['quantity'] = row.get('quantity') or 1
+            records[-1][1]['items'].append(item)
+    return [(line_number, data) for line_number, data, _ in records]
+
+
+class PresetLookup(object):
+    """ Resolve preset references of all imported plans with single query """
+
+    def __init__(self, references):
+        uuids = {reference for reference in references if isinstance(reference, six.string_types)}
+        triples = [reference for reference in references if isinstance(reference, tuple)]
+        self.by_uuid = {}
+        self.by_name = {}
+
+        if not uuids and not triples:
+            return
+
+        presets = models.Preset.objects.filter(uuid__in=_valid_uuids(uuids)) if uuids else models.Preset.objects.none()
+        if triples:
+            presets |= models.Preset.objects.filter(
+                category__name__in={category for category, _, _ in triples},
+                name__in={name for _, name, _ in triples},
+            )
+
+        for preset in presets.select_related('category'):
+            self.by_uuid[preset.uuid.hex] = preset
+            self.by_name[(preset.category.name, preset.name, preset.variant)] = preset
+
+    def get(self, reference):
+        if isinstance(reference, tuple):
+            return self.by_name.get(reference)
+        return self.by_uuid.get(reference)
+
+
+def _valid_uuids(values):
+    result = set()
+    for value in values:
+        try:
+            result.add(UUID(value).hex)
+        except (TypeError, ValueError, AttributeError):
+            pass
+    return result
+
+
+def _get_uuid(value):
+    return UUID(force_text(value)).hex
+
+
+def _get_preset_reference(item):
+    if item.get('preset'):
+        return force_text(item['preset']).replace('-', '').lower()
+    return (force_text(item.get('category', '')), force_text(item.get('name', '')),
+            force_text(item.get('variant', '')).lower())
+
+
+def _get_quantity(item):
+    try:
+        quantity = int(item.get('quantity', 1))
+    except (TypeError, ValueError):
+        return None
+    if 0 <= quantity <= MAX_QUANTITY:
+        return quantity
+
+
+def import_plans(records, request, view):
+    """
+    Validate all records in batch and create plans, their items and
+    certifications by bulk inserts in single transaction.
+    Projects, presets and certifications are resolved by one query each.
+    """
+    project_uuids = _valid_uuids(force_text(data.get('project', '')) for _, data in records)
+    projects = filter_queryset_for_user(
+        structure_models.Project.objects.filter(uuid__in=project_uuids), request.user)
+    projects = {project.uuid.hex: project for project in projects}
+    for project in projects.values():
+        structure_permissions.is_administrator(request, view, project)
+
+    certification_uuids = _valid_uuids(force_text(uuid) for _, data in records
+                                       for uuid in data.get('certifications') or [])
+    certifications = structure_models.ServiceCertification.objects.filter(uuid__in=certification_uuids)
+    certifications = {certification.uuid.hex: certification for certification in certifications}
+
+    presets = PresetLookup({_get_preset_reference(item) for _, data in records
+                            for item in data.get('items') or [] if isinstance(item, dict)})
+
+    errors = []
+    plans = []
+    for line_number, data in records:
+        plan, plan_errors = _build_plan(data, projects, certifications, presets)
+        errors.extend('Line %s: %s' % (line_number, error) for error in plan_errors)
+        plans.append(plan)
+
+    if errors:
+        raise exceptions.ValidationError(errors)
+
+    with transaction.atomic():
+        models.DeploymentPlan.objects.bulk_create(plan for plan, _, _ in plans)
+        # bulk_create does not set primary keys on every database backend
+        plan_ids = {_get_uuid(uuid): plan_id for uuid, plan_id in models.DeploymentPlan.objects.filter(
+            uuid__in=[plan.uuid for plan, _, _ in plans]).values_list('uuid', 'id')}
+        for plan, _, _ in plans:
+            plan.id = plan_ids[_get_uuid(plan.uuid)]
+
+        models.DeploymentPlanItem.objects.bulk_create(
+            models.DeploymentPlanItem(plan=plan, preset=preset, quantity=quantity)
+            for plan, items, _ in plans for preset, quantity in items)
+
+        through = models.DeploymentPlan.certifications.through
+        through.objects.bulk_create(
+            through(deploymentplan_id=plan.id, servicecertification_id=certification.id)
+            for plan, _, plan_certifications in plans for certification in plan_certifications)
+
+    return [plan for plan, _, _ in plans]
+
+
+def _build_plan(data, projects, certifications, presets):
+    errors = []
+    name = force_text(data.get('name') or '').strip()
+    if not name:
+        errors.append('Plan name is required.')
+    elif len(name) > models.DeploymentPlan._meta.get_field('name').max_length:
+        errors.append('Plan name "%s" is too long.' % name)
+
+    project_uuid = force_text(data.get('project') or '').replace('-', '').lower()
+    project = projects.get(project_uuid)
+    if project is None:
+        errors.append('Project "%s" is not found.' % project_uuid)
+
+    plan_certifications = []
+    for uuid in data.get('certifications') or []:
+        certification = certifications.get(force_text(uuid).replace('-', '').lower())
+        if certification is None:
+            errors.append('Certification "%s" is not found.' % uuid)
+        else:
+            plan_certifications.append(certification)
+
+    items = []
+    seen = set()
+    for item in data.get('items') or []:
+        if not isinstance(item, dict):
+            errors.append('Plan item should be an object.')
+            continue
+        reference = _get_preset_reference(item)
+        label = reference if isinstance(reference, six.string_types) else ' '.join(reference)
+        preset = presets.get(reference)
+        quantity = _get_quantity(item)
+        if preset is None:
+            errors.append('Preset "%s" is not found.' % label)
+        elif preset.id in seen:
+            errors.append('Preset "%s" is listed more than once.' % label)
+        elif quantity is None:
+            errors.append('Quantity of preset "%s" should be an integer between 0 and %s.' % (label, MAX_QUANTITY))
+        else:
+            seen.add(preset.id)
+            items.append((preset, quantity))
+
+    # Requirements are calculated in advance, because items are created by bulk insert
+    plan = models.DeploymentPlan(name=name, project=project, **{
+        resource: sum(getattr(preset, resource) * quantity for preset, quantity in items)
+        for resource in ('ram', 'cores', 'storage')
+    })
+    return (plan, items, plan_certifications), errors
+
+
+def export_plans(queryset, file_format):
+    """
+    Yield plans serialized as JSON lines or CSV rows.
+    Plans are loaded in chunks, so memory usage does not depend on number of plans.
+    """
+    if file_format == CSV:
+        yield _format_csv_row(CSV_FIELDS)
+
+    plan_ids = list(queryset.values_list('id', flat=True))
+    for start in range(0, len(plan_ids), EXPORT_CHUNK_SIZE):
+        chunk = plan_ids[start:start + EXPORT_CHUNK_SIZE]
+        plans = {plan.id: plan for plan in queryset.filter(id__in=chunk)}
+        for plan_id in chunk:
+            plan = plans[plan_id]
+            if file_format == CSV:
+                for row in _get_csv_rows(plan):
+                    yield _format_csv_row(row)
+            else:
+                yield json.dumps(_get_plan_data(plan), sort_keys=True) + '\n'
+
+
+def _get_plan_data(plan):
+    return {
+        'name': plan.name,
+        'project': plan.project.uuid.hex,
+        'certifications': [certification.uuid.hex for certification in plan.certifications.all()],
+        'items': [{
+            'preset': item.preset.uuid.hex,
+            'category': item.preset.category.name,
+            'name': item.preset.name,
+            'variant': item.preset.variant,
+            'quantity': item.quantity,
+        } for item in plan.items.all()],
+    }
+
+
+def _get_csv_rows(plan):
+    data = _get_plan_data(plan)
+    prefix = (data['name'], data['project'], ' '.join(data['certifications']))
+    if not data['items']:
+        yield prefix + ('', '', '', '', '')
+    for item in data['items']:
+        yield prefix + (item['preset'], item['category'], item['name'], item['variant'], item['quantity'])
+
+
+def _format_csv_row(values):
+    if six.PY2:
+        stream = six.BytesIO()
+        csv.writer(stream).writerow([force_bytes(value) for value in values])
+    else:
+        stream = six.StringIO()
+        csv.writer(stream).writerow([force_text(value) for value in values])
+    return force_text(stream.getvalue())
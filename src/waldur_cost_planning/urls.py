@@ -4,3 +4,4 @@ from . import views
 def register_in(router):
     router.register(r'deployment-plans', views.DeploymentPlanViewSet, base_name='deployment-plan')
     router.register(r'deployment-presets', views.PresetViewSet, base_name='deployment-preset')
+    router.register(r'deployment-plan-evaluations', views.EvaluationJobViewSet, base_name='deployment-plan-evaluation')